@@ -1,13 +1,28 @@
+import io
 import os
+import argparse
 import uuid
 import tempfile
 import sys
 import traceback
 import logging
+import threading
 import time
-from flask import Flask, request, render_template, send_file, jsonify
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, request, render_template, send_file, jsonify
 from werkzeug.utils import secure_filename
-from pdf_night_mode import convert_pdf_to_night_mode
+from pdf_night_mode import (
+    convert_bytes,
+    SIZE_BASED_QUALITY,
+    plan_pdf_chunks,
+    process_pdf_in_chunks,
+    combine_pdf_chunks,
+    convert_pdf_progressive,
+    invalidate_document,
+    checkout_document,
+    parse_device,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -15,28 +30,119 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+class UploadRequest(Request):
+    """Request that keeps uploads to the conversion form in memory"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Werkzeug spools uploads over 500KB to a temporary file, which the
+        # in-memory conversion would only read back; other routes keep the default
+        if self.path == '/':
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # Configure max content length
-MAX_FILE_SIZE = 2 * 1024 * 1024  # 2MB max upload size
+MAX_FILE_SIZE = 2 * 1024 * 1024  # 2MB max size for single-request processing
+MAX_CHUNKED_FILE_SIZE = 50 * 1024 * 1024  # 50MB max upload size, processed in chunks
 SERVERLESS_MODE = os.environ.get('VERCEL_ENV') is not None  # Detect if running on Vercel
 
-# Set content length based on environment
+# Larger files are accepted and handed to the chunked workflow
+app.config['MAX_CONTENT_LENGTH'] = MAX_CHUNKED_FILE_SIZE
+
+# Set storage locations based on environment
 if SERVERLESS_MODE:
-    app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+    UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'uploads')
+    RESULT_FOLDER = os.path.join(tempfile.gettempdir(), 'results')
     app.logger.info(f"Running in serverless mode with {MAX_FILE_SIZE/1024/1024}MB limit")
 else:
-    app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+    UPLOAD_FOLDER = 'uploads'
+    RESULT_FOLDER = 'results'
     app.logger.info(f"Running in normal mode with {MAX_FILE_SIZE/1024/1024}MB limit")
 
-# Create upload and result directories if not in serverless mode
-if not SERVERLESS_MODE:
-    os.makedirs('uploads', exist_ok=True)
-    os.makedirs('results', exist_ok=True)
+# Create upload and result directories, used to keep files between chunk requests
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(RESULT_FOLDER, exist_ok=True)
+
+# Progressive conversions run in the background on a small pool; each can hold
+# many display lists, so the number of accepted jobs (running and queued) is capped
+PROGRESSIVE_WORKERS = 2
+PROGRESSIVE_MAX_JOBS = 8
+progressive_executor = ThreadPoolExecutor(max_workers=PROGRESSIVE_WORKERS)
+progressive_slots = threading.BoundedSemaphore(PROGRESSIVE_MAX_JOBS)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'pdf'
 
+def find_upload(process_id):
+    """Locate the uploaded PDF of a chunked processing session"""
+    try:
+        uuid.UUID(str(process_id))
+    except ValueError:
+        return None
+    
+    for filename in os.listdir(UPLOAD_FOLDER):
+        if filename.startswith(f"{process_id}_"):
+            return os.path.join(UPLOAD_FOLDER, filename)
+    return None
+
+@app.context_processor
+def inject_serverless_mode():
+    """Make the deployment mode available to every template, including error pages"""
+    return {"serverless_mode": SERVERLESS_MODE}
+
+def requested_device(value):
+    """Parse an optional target device from a request, ignoring empty or unknown values"""
+    if not value:
+        return None
+    try:
+        return parse_device(value)
+    except argparse.ArgumentTypeError:
+        app.logger.warning(f"Ignoring unknown device: {value}")
+        return None
+
+def chunk_output_path(process_id, start_page, end_page):
+    return os.path.join(RESULT_FOLDER, f"{process_id}_chunk_{start_page}_{end_page}.pdf")
+
+def covers_document(page_ranges, total_pages):
+    """Check that sorted (start, end) page ranges cover every page exactly once"""
+    expected_start = 0
+    for start, end in page_ranges:
+        if start != expected_start or end <= start:
+            return False
+        expected_start = end
+    return expected_start == total_pages
+
+def result_paths(process_id):
+    """Paths of the final and the preview result of a session"""
+    return (os.path.join(RESULT_FOLDER, f"{process_id}_night_mode.pdf"),
+            os.path.join(RESULT_FOLDER, f"{process_id}_preview.pdf"))
+
+def failure_marker_path(process_id):
+    """Path of the file recording that a progressive conversion failed"""
+    return os.path.join(RESULT_FOLDER, f"{process_id}_failed")
+
+def start_chunked_processing(pdf_data, original_filename, device=None):
+    """Store a large upload and show the chunk processing page with its chunk plan"""
+    process_id = str(uuid.uuid4())
+    input_path = os.path.join(UPLOAD_FOLDER, f"{process_id}_{original_filename}")
+    with open(input_path, 'wb') as f:
+        f.write(pdf_data)
+    app.logger.info(f"Saved large file for chunked processing: {input_path}")
+    
+    # Chunks are cut from the estimated cost of each page at the scale it will be rendered at
+    chunk_plan = plan_pdf_chunks(input_path, device=device)
+    if not chunk_plan:
+        return render_template('index.html', error='Error reading PDF. Could not plan processing.')
+    
+    return render_template('chunks.html',
+                           filename=original_filename,
+                           total_pages=chunk_plan[-1]['end'],
+                           process_id=process_id,
+                           chunk_plan=chunk_plan,
+                           device=device)
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
@@ -58,91 +164,50 @@ def upload_file():
             app.logger.info(f"File received: {file.filename}")
             
             if file and allowed_file(file.filename):
-                # Generate unique filename to avoid collisions
                 original_filename = secure_filename(file.filename)
-                unique_id = str(uuid.uuid4())
                 
-                if SERVERLESS_MODE:
-                    # In serverless mode, use tempfile for processing
-                    try:
-                        # Create temporary directory
-                        temp_dir = tempfile.mkdtemp(prefix="pdf_night_")
-                        app.logger.info(f"Created temp directory: {temp_dir}")
-                        
-                        # Save uploaded file
-                        input_path = os.path.join(temp_dir, original_filename)
-                        file.save(input_path)
-                        app.logger.info(f"Saved input file to {input_path}")
-                        
-                        # Check file size
-                        file_size = os.path.getsize(input_path)
-                        app.logger.info(f"File size: {file_size} bytes")
-                        
-                        if file_size <= MAX_FILE_SIZE:
-                            # Process the file
-                            app.logger.info("Processing file")
-                            output_filename = f"night_mode_{original_filename}"
-                            output_path = os.path.join(temp_dir, output_filename)
-                            
-                            success = convert_pdf_to_night_mode(input_path, output_path)
-                            
-                            if success:
-                                app.logger.info(f"PDF conversion successful: {output_path}")
-                                
-                                # Check output file size
-                                output_size = os.path.getsize(output_path)
-                                if output_size > MAX_FILE_SIZE:
-                                    return render_template('index.html', 
-                                                      error='Converted PDF is too large for download. Please try a smaller document.')
-                                
-                                # Serve the file
-                                return send_file(
-                                    output_path,
-                                    as_attachment=True,
-                                    download_name=output_filename
-                                )
-                            else:
-                                return render_template('index.html', error='Error processing PDF. Conversion failed.')
-                        else:
-                            # For large files, suggest local processing
-                            return render_template('index.html', 
-                                     error='This file is too large for online processing. Please download the local converter.',
-                                     show_download_local=True)
-                    
-                    except Exception as e:
-                        app.logger.error(f"Processing error: {str(e)}")
-                        app.logger.error(traceback.format_exc())
-                        return render_template('index.html', error=f'Processing error: {str(e)}')
+                # The upload is held in memory by UploadRequest, so this reads no file from disk
+                pdf_data = file.read()
+                file_size = len(pdf_data)
+                app.logger.info(f"File size: {file_size} bytes")
+                
+                # Render for the reader's device if one was chosen
+                device = requested_device(request.form.get('device'))
                 
-                else:
-                    # In normal mode, use regular directories
-                    filename = f"{unique_id}_{original_filename}"
-                    input_path = os.path.join('uploads', filename)
-                    file.save(input_path)
+                if file_size > MAX_FILE_SIZE:
+                    # Large files are processed in chunks across several requests
+                    return start_chunked_processing(pdf_data, original_filename, device)
+                
+                try:
+                    # Process the file in memory
+                    app.logger.info("Processing file")
+                    output_filename = f"night_mode_{original_filename}"
+                    # The scale follows the document size to keep the response small
+                    output_data = convert_bytes(pdf_data, scale=None, quality=SIZE_BASED_QUALITY, device=device)
+                    pdf_data = None
                     
-                    # Check file size
-                    file_size = os.path.getsize(input_path)
-                    if file_size > MAX_FILE_SIZE:
-                        return render_template('index.html', 
-                                    error='This file is too large for online processing. Please download the local converter.',
-                                    show_download_local=True)
+                    if output_data is None:
+                        return render_template('index.html', error='Error processing PDF. Conversion failed.')
                     
-                    # Generate output filename
-                    output_filename = f"night_mode_{original_filename}"
-                    output_path = os.path.join('results', output_filename)
+                    app.logger.info(f"PDF conversion successful: {len(output_data)} bytes")
                     
-                    # Process the file
-                    success = convert_pdf_to_night_mode(input_path, output_path)
+                    # Check output size against the serverless response limit
+                    if SERVERLESS_MODE and len(output_data) > MAX_FILE_SIZE:
+                        return render_template('index.html', 
+                                          error='Converted PDF is too large for download. Please try a smaller document.')
                     
-                    if success:
-                        # Serve the file
-                        return send_file(
-                            output_path,
-                            as_attachment=True,
-                            download_name=output_filename
-                        )
-                    else:
-                        return render_template('index.html', error='Error processing PDF')
+                    # Serve the result from memory; send_file sets Content-Length from the buffer
+                    return send_file(
+                        io.BytesIO(output_data),
+                        mimetype='application/pdf',
+                        as_attachment=True,
+                        download_name=output_filename
+                    )
+                
+                except Exception as e:
+                    app.logger.error(f"Processing error: {str(e)}")
+                    app.logger.error(traceback.format_exc())
+                    return render_template('index.html', error=f'Processing error: {str(e)}')
             else:
                 app.logger.warning(f"Invalid file type: {file.filename}")
                 return render_template('index.html', error='Invalid file type. Only PDF files are allowed.')
@@ -155,6 +220,219 @@ def upload_file():
     # If GET request or any other case
     return render_template('index.html', serverless_mode=SERVERLESS_MODE, size_limit=MAX_FILE_SIZE)
 
+@app.route('/api/chunk-plan/<process_id>')
+def chunk_plan(process_id):
+    """Return the chunk plan of a chunked processing session, optionally for a target device"""
+    input_path = find_upload(process_id)
+    if input_path is None:
+        return jsonify({"success": False, "error": "Unknown process ID"}), 404
+    
+    chunks = plan_pdf_chunks(input_path, device=requested_device(request.args.get('device')))
+    if chunks is None:
+        return jsonify({"success": False, "error": "Could not plan chunks"}), 500
+    
+    return jsonify({"success": True, "chunks": chunks})
+
+@app.route('/api/process-chunk', methods=['POST'])
+def process_chunk():
+    """Convert one page range of a chunked processing session"""
+    try:
+        data = request.get_json(silent=True) or {}
+        process_id = data.get('process_id')
+        start_page = data.get('start_page')
+        end_page = data.get('end_page')
+        
+        input_path = find_upload(process_id)
+        if input_path is None:
+            return jsonify({"success": False, "error": "Unknown process ID"}), 404
+        
+        # bool is a subclass of int, but true/false are not page numbers
+        if not all(isinstance(page, int) and not isinstance(page, bool) for page in (start_page, end_page)):
+            return jsonify({"success": False, "error": "Invalid page range"}), 400
+        
+        # The document stays in the cache for the conversion that follows
+        with checkout_document(input_path) as doc_in:
+            total_pages = len(doc_in)
+        if start_page < 0 or end_page > total_pages or start_page >= end_page:
+            return jsonify({"success": False, "error": f"Invalid page range, the document has {total_pages} pages"}), 400
+        
+        output_path = chunk_output_path(process_id, start_page, end_page)
+        device = requested_device(data.get('device'))
+        if process_pdf_in_chunks(input_path, output_path, start_page, end_page, device):
+            return jsonify({"success": True, "message": f"Processed pages {start_page + 1} to {end_page}"})
+        
+        return jsonify({"success": False, "error": f"Failed to process pages {start_page + 1} to {end_page}"}), 500
+    
+    except Exception as e:
+        app.logger.error(f"Chunk processing error: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({"success": False, "error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/combine-chunks', methods=['POST'])
+def combine_chunks():
+    """Merge the processed chunks of a session into the final PDF"""
+    try:
+        data = request.get_json(silent=True) or {}
+        process_id = data.get('process_id')
+        
+        input_path = find_upload(process_id)
+        if input_path is None:
+            return jsonify({"success": False, "error": "Unknown process ID"}), 404
+        
+        # Chunk IDs have the form "<start>_<end>"; merge them in page order
+        try:
+            page_ranges = sorted(tuple(int(part) for part in chunk_id.split('_'))
+                                 for chunk_id in data.get('chunks', []))
+        except (AttributeError, ValueError):
+            return jsonify({"success": False, "error": "Invalid chunk list"}), 400
+        if any(len(page_range) != 2 for page_range in page_ranges):
+            return jsonify({"success": False, "error": "Invalid chunk list"}), 400
+        
+        # The chunks must cover every page exactly once, without gaps or overlaps
+        with checkout_document(input_path) as doc_in:
+            total_pages = len(doc_in)
+        if not covers_document(page_ranges, total_pages):
+            return jsonify({"success": False, "error": "Chunks do not cover every page of the document exactly once"}), 400
+        
+        chunk_paths = [chunk_output_path(process_id, start, end) for start, end in page_ranges]
+        missing = [path for path in chunk_paths if not os.path.exists(path)]
+        if not chunk_paths or missing:
+            return jsonify({"success": False, "error": "Some chunks have not been processed"}), 400
+        
+        output_path, _ = result_paths(process_id)
+        if not combine_pdf_chunks(chunk_paths, output_path):
+            return jsonify({"success": False, "error": "Failed to combine chunks"}), 500
+        
+        return jsonify({"success": True, "redirect": f"/download/{process_id}"})
+    
+    except Exception as e:
+        app.logger.error(f"Combine error: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({"success": False, "error": f"Server error: {str(e)}"}), 500
+
+@app.route('/download/<process_id>')
+def download_result(process_id):
+    """Serve the result of a chunked or progressive session, or its preview while the full result is pending"""
+    input_path = find_upload(process_id)
+    if input_path is None:
+        return render_template('index.html', error='Converted file not found. It may have expired.')
+    
+    original_filename = os.path.basename(input_path)[len(process_id) + 1:]
+    output_path, preview_path = result_paths(process_id)
+    if os.path.exists(output_path):
+        download_path, download_name = output_path, f"night_mode_{original_filename}"
+    elif os.path.exists(preview_path):
+        download_path, download_name = preview_path, f"night_mode_preview_{original_filename}"
+    else:
+        return render_template('index.html', error='Converted file not found. It may have expired.')
+    
+    return send_file(
+        download_path,
+        as_attachment=True,
+        download_name=download_name
+    )
+
+# Modules the local converter needs, zipped from this deployment so the download matches the code
+LOCAL_CONVERTER_MODULES = ['local_converter.py', 'pdf_night_mode.py', 'page_index.py']
+LOCAL_CONVERTER_REQUIREMENTS = ('pymupdf', 'pillow')
+
+def build_local_converter_bundle():
+    """Zip the local converter with the modules it imports and its requirements"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(app_dir, 'requirements.txt')) as f:
+        requirements = [line for line in f.read().splitlines()
+                        if line.lower().startswith(LOCAL_CONVERTER_REQUIREMENTS)]
+    
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name in LOCAL_CONVERTER_MODULES:
+            bundle.write(os.path.join(app_dir, name), f'local_converter/{name}')
+        bundle.writestr('local_converter/requirements.txt', '\n'.join(requirements) + '\n')
+    return buffer.getvalue()
+
+@app.route('/local-converter.zip')
+def download_local_converter():
+    return send_file(
+        io.BytesIO(build_local_converter_bundle()),
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name='local_converter.zip'
+    )
+
+@app.route('/api/progressive', methods=['POST'])
+def start_progressive():
+    """Start a progressive conversion: a quick preview first, then full quality in the background"""
+    if SERVERLESS_MODE:
+        # Background work does not survive the end of a serverless request
+        return jsonify({"success": False, "error": "Progressive conversion is not available in serverless mode"}), 400
+    
+    file = request.files.get('file')
+    if file is None or not allowed_file(file.filename):
+        return jsonify({"success": False, "error": "Invalid file type. Only PDF files are allowed."}), 400
+    
+    if not progressive_slots.acquire(blocking=False):
+        return jsonify({"success": False, "error": "Too many conversions in progress, please try again shortly"}), 503
+    
+    submitted = False
+    try:
+        original_filename = secure_filename(file.filename)
+        process_id = str(uuid.uuid4())
+        input_path = os.path.join(UPLOAD_FOLDER, f"{process_id}_{original_filename}")
+        file.save(input_path)
+        
+        device = requested_device(request.form.get('device'))
+        output_path, preview_path = result_paths(process_id)
+        
+        def run_conversion():
+            try:
+                if not convert_pdf_progressive(input_path, preview_path, output_path, device=device):
+                    # Recorded on disk so status requests served by any worker process see it
+                    with open(failure_marker_path(process_id), 'w') as f:
+                        f.write("Conversion failed")
+            finally:
+                progressive_slots.release()
+        
+        progressive_executor.submit(run_conversion)
+        submitted = True
+        app.logger.info(f"Started progressive conversion {process_id} for {original_filename}")
+        
+        return jsonify({"success": True, "process_id": process_id, "status_url": f"/api/progressive/{process_id}"})
+    
+    except Exception as e:
+        if not submitted:
+            progressive_slots.release()
+        app.logger.error(f"Progressive start error: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({"success": False, "error": f"Server error: {str(e)}"}), 500
+
+@app.route('/api/progressive/<process_id>')
+def progressive_status(process_id):
+    """Report whether the preview and the full-quality result of a progressive conversion are ready"""
+    if find_upload(process_id) is None:
+        return jsonify({"success": False, "error": "Unknown process ID"}), 404
+    
+    # Status is derived from the result files so any worker process can answer
+    output_path, preview_path = result_paths(process_id)
+    failure_path = failure_marker_path(process_id)
+    error = None
+    if os.path.exists(output_path):
+        status = 'complete'
+    elif os.path.exists(failure_path):
+        status = 'failed'
+        with open(failure_path) as f:
+            error = f.read()
+    elif os.path.exists(preview_path):
+        status = 'preview'
+    else:
+        status = 'processing'
+    
+    return jsonify({
+        "success": status != 'failed',
+        "status": status,
+        "download_url": f"/download/{process_id}" if status in ('preview', 'complete') else None,
+        "error": error
+    })
+
 # Health check endpoint with system info
 @app.route('/health')
 def health_check():
@@ -175,22 +453,20 @@ def health_check():
 # Cleanup temporary files when the app is shutting down
 @app.teardown_appcontext
 def cleanup_temp_files(exception):
-    if SERVERLESS_MODE:
-        # In serverless mode, no need for manual cleanup
-        pass
-    else:
-        # In normal mode, periodically clean up old files
-        try:
-            # Clean files older than 1 hour
-            current_time = time.time()
-            for folder in ['uploads', 'results']:
-                for filename in os.listdir(folder):
-                    filepath = os.path.join(folder, filename)
-                    # If file is older than 1 hour, delete it
-                    if os.path.isfile(filepath) and os.path.getmtime(filepath) < current_time - 3600:
-                        os.remove(filepath)
-        except Exception as e:
-            app.logger.warning(f"Error during cleanup: {str(e)}")
+    # Periodically clean up old files; serverless instances are reused too, and
+    # chunked uploads in /tmp would otherwise stay until the instance is recycled
+    try:
+        # Clean files older than 1 hour
+        current_time = time.time()
+        for folder in [UPLOAD_FOLDER, RESULT_FOLDER]:
+            for filename in os.listdir(folder):
+                filepath = os.path.join(folder, filename)
+                # If file is older than 1 hour, delete it
+                if os.path.isfile(filepath) and os.path.getmtime(filepath) < current_time - 3600:
+                    invalidate_document(filepath)
+                    os.remove(filepath)
+    except Exception as e:
+        app.logger.warning(f"Error during cleanup: {str(e)}")
 
 @app.route('/system-check')
 def system_check():
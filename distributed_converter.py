@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import queue
+import socket
+import struct
+import time
+import argparse
+import logging
+import threading
+import socketserver
+import traceback
+import fitz  # PyMuPDF
+from pdf_night_mode import plan_chunks, process_chunk_bytes
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Default port workers listen on
+DEFAULT_PORT = 8765
+# Estimated processing time in seconds for one task sent to a worker
+TASK_TIME_BUDGET = 30.0
+# Seconds a worker may take for one task, including sending the result, before it is retried elsewhere
+TASK_TIMEOUT = 300.0
+# Seconds to wait for a worker to accept a connection
+CONNECT_TIMEOUT = 10.0
+# Number of times a task is attempted before its pages are given up
+MAX_ATTEMPTS = 3
+
+# Wire protocol: every message is a 4-byte big-endian header length, a JSON
+# header and a payload of header["size"] bytes.
+
+def send_message(sock, header, payload=b""):
+    """Send a header and payload over a socket"""
+    header_data = json.dumps(dict(header, size=len(payload))).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(header_data)) + header_data)
+    sock.sendall(payload)
+
+class WorkerUnavailableError(ConnectionError):
+    """A worker could not be reached at all"""
+
+def _recv_exact(sock, size, deadline=None):
+    """Read exactly size bytes from a socket, failing once the time.monotonic() deadline has passed"""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        # The socket timeout only bounds each recv, so a worker trickling data
+        # would never time out without an overall deadline
+        if deadline is not None:
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                raise TimeoutError("Task deadline exceeded")
+            sock.settimeout(time_left)
+        data = sock.recv(min(remaining, 1024 * 1024))
+        if not data:
+            raise ConnectionError("Connection closed before message was complete")
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
+
+def recv_message(sock, deadline=None):
+    """Receive a header and payload from a socket"""
+    (header_length,) = struct.unpack("!I", _recv_exact(sock, 4, deadline))
+    header = json.loads(_recv_exact(sock, header_length, deadline).decode("utf-8"))
+    payload = _recv_exact(sock, header.get("size", 0), deadline)
+    return header, payload
+
+def parse_address(address):
+    """Split a 'host:port' string, using DEFAULT_PORT if no port is given"""
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+class ConversionHandler(socketserver.BaseRequestHandler):
+    """Convert one page-range task per connection"""
+
+    def handle(self):
+        try:
+            header, payload = recv_message(self.request)
+            if header.get("command") != "convert":
+                send_message(self.request, {"success": False, "error": f"Unknown command: {header.get('command')}"})
+                return
+
+            logger.info(f"Task {header.get('task')}: converting {len(payload)} bytes from {self.client_address[0]}")
+            output_data = process_chunk_bytes(payload)
+
+            if output_data is None:
+                send_message(self.request, {"success": False, "error": "Conversion failed"})
+            else:
+                logger.info(f"Task {header.get('task')}: done, {len(output_data)} bytes")
+                send_message(self.request, {"success": True}, output_data)
+
+        except Exception as e:
+            logger.error(f"Error handling task: {e}")
+            logger.error(traceback.format_exc())
+
+class WorkerServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+def run_worker(host="127.0.0.1", port=DEFAULT_PORT):
+    """
+    Serve conversion tasks until interrupted
+
+    A worker converts one task at a time; start one worker per core to use
+    every core of a host.
+    """
+    with WorkerServer((host, port), ConversionHandler) as server:
+        logger.info(f"Worker listening on {host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Worker stopped")
+
+def send_task(address, task_no, pdf_data, timeout=TASK_TIMEOUT):
+    """
+    Send a page-range task to a worker and wait for the converted PDF
+
+    The whole exchange must complete within timeout seconds.
+
+    Raises:
+        WorkerUnavailableError: If the worker cannot be reached
+        OSError: If the worker times out or reports a failure
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        sock = socket.create_connection(parse_address(address), timeout=min(CONNECT_TIMEOUT, timeout))
+    except OSError as e:
+        raise WorkerUnavailableError(f"Cannot reach worker {address}: {e}")
+
+    with sock:
+        sock.settimeout(max(0.001, deadline - time.monotonic()))
+        send_message(sock, {"command": "convert", "task": task_no}, pdf_data)
+        header, payload = recv_message(sock, deadline)
+
+    if not header.get("success"):
+        raise OSError(header.get("error", "Worker reported a failure"))
+    return payload
+
+def result_page_count(pdf_data):
+    """
+    Count the pages of a converted PDF returned by a worker
+
+    Raises:
+        ValueError: If the data is not a readable PDF
+    """
+    try:
+        doc = fitz.open(stream=pdf_data, filetype="pdf")
+    except Exception as e:
+        raise ValueError(f"Worker returned an unreadable PDF: {e}")
+    page_count = doc.page_count
+    doc.close()
+    return page_count
+
+def coordinate(input_path, output_path, workers, task_time_budget=TASK_TIME_BUDGET,
+               task_timeout=TASK_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+    """
+    Convert a PDF by distributing page ranges across worker processes
+
+    The document is split with plan_chunks, each range is extracted into a
+    small PDF and sent to a worker. Workers that cannot be reached are taken
+    out of rotation without using up the task's attempts. Tasks that fail,
+    including results with pages missing, or take longer than task_timeout
+    are retried, preferring live workers that have not failed them yet.
+    Results are merged in page order. If any task still fails after
+    max_attempts, or no worker is left, no output is written.
+
+    Args:
+        input_path: Path to the input PDF file
+        output_path: Path to save the night mode PDF
+        workers: List of worker addresses as 'host:port'
+        task_time_budget: Estimated processing time per task in seconds
+        task_timeout: Seconds a worker may take for a task before it is retried
+        max_attempts: Attempts per task before the conversion fails
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    if not os.path.exists(input_path):
+        logger.error(f"Error: Input file '{input_path}' not found.")
+        return False
+    if not workers:
+        logger.error("No workers given")
+        return False
+
+    try:
+        doc_in = fitz.open(input_path)
+        tasks = plan_chunks(doc_in, task_time_budget)
+        logger.info(f"Distributing {len(doc_in)} pages as {len(tasks)} tasks over {len(workers)} workers")
+
+        # PyMuPDF documents are not thread-safe, so extraction is serialized
+        doc_lock = threading.Lock()
+        state_lock = threading.Lock()
+        pending = queue.Queue()
+        for task_no in range(len(tasks)):
+            pending.put(task_no)
+
+        results = {}
+        attempts = [0] * len(tasks)
+        failed_workers = [set() for _ in tasks]
+        live_workers = set(workers)
+        remaining = [len(tasks)]
+
+        def extract_task(task_no):
+            task = tasks[task_no]
+            with doc_lock:
+                doc_task = fitz.open()
+                doc_task.insert_pdf(doc_in, from_page=task["start"], to_page=task["end"] - 1)
+                data = doc_task.tobytes()
+                doc_task.close()
+            return data
+
+        def run_tasks(address):
+            while True:
+                with state_lock:
+                    if remaining[0] == 0:
+                        return
+                try:
+                    task_no = pending.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                # Leave tasks this worker already failed to the others while any are untried
+                with state_lock:
+                    skip = (address in failed_workers[task_no]
+                            and bool(live_workers - failed_workers[task_no]))
+                if skip:
+                    pending.put(task_no)
+                    time.sleep(0.1)
+                    continue
+
+                task = tasks[task_no]
+                try:
+                    output_data = send_task(address, task_no, extract_task(task_no), task_timeout)
+
+                    # Workers skip pages that fail to convert, which must not go unnoticed
+                    with doc_lock:
+                        page_count = result_page_count(output_data)
+                    if page_count != task["end"] - task["start"]:
+                        raise ValueError(f"result has {page_count} of {task['end'] - task['start']} pages")
+
+                    with state_lock:
+                        results[task_no] = output_data
+                        remaining[0] -= 1
+                    logger.info(f"Pages {task['start']+1}-{task['end']} converted by {address}")
+
+                except WorkerUnavailableError as e:
+                    # An unreachable worker is not the task's fault; hand it back and stop using the worker
+                    with state_lock:
+                        live_workers.discard(address)
+                        workers_left = len(live_workers)
+                    pending.put(task_no)
+                    logger.warning(f"{e}, {workers_left} workers left")
+                    return
+
+                except (OSError, ValueError) as e:
+                    with state_lock:
+                        attempts[task_no] += 1
+                        failed_workers[task_no].add(address)
+                        retry = attempts[task_no] < max_attempts
+                        if not retry:
+                            remaining[0] -= 1
+                    if retry:
+                        logger.warning(f"Pages {task['start']+1}-{task['end']} failed on {address} ({e}), retrying")
+                        pending.put(task_no)
+                    else:
+                        logger.error(f"Pages {task['start']+1}-{task['end']} failed {max_attempts} times, giving up")
+
+        threads = [threading.Thread(target=run_tasks, args=(address,), daemon=True) for address in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # An output with whole page ranges missing must not pass as a conversion
+        # (tasks still pending when the last worker became unreachable are missing too)
+        failed_tasks = len(tasks) - len(results)
+        if failed_tasks:
+            logger.error(f"{failed_tasks} of {len(tasks)} tasks failed, no output written")
+            doc_in.close()
+            return False
+
+        # Merge results in page order
+        doc_out = fitz.open()
+        for task_no in range(len(tasks)):
+            if task_no in results:
+                doc_result = fitz.open(stream=results.pop(task_no), filetype="pdf")
+                doc_out.insert_pdf(doc_result)
+                doc_result.close()
+
+        if doc_out.page_count == 0:
+            logger.error("No pages were successfully processed")
+            return False
+
+        logger.info(f"Saving output PDF: {output_path}")
+        doc_out.save(output_path, garbage=4, deflate=True, clean=True)
+        doc_out.close()
+        doc_in.close()
+        return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+
+    except Exception as e:
+        logger.error(f"Error converting PDF: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert PDFs to night mode across several worker processes or hosts')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker_parser = subparsers.add_parser('worker', help='Run a conversion worker')
+    worker_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    worker_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port to listen on (default: {DEFAULT_PORT})')
+
+    coordinator_parser = subparsers.add_parser('coordinate', help='Distribute a PDF across workers')
+    coordinator_parser.add_argument('input_pdf', help='Path to the input PDF file')
+    coordinator_parser.add_argument('-o', '--output', help='Path to save the night mode PDF (default: adds _night_mode suffix)')
+    coordinator_parser.add_argument('-w', '--worker', action='append', required=True, dest='workers',
+                                    help='Worker address as host:port (repeat for each worker)')
+    coordinator_parser.add_argument('--timeout', type=float, default=TASK_TIMEOUT,
+                                    help=f'Seconds before a slow task is retried on another worker (default: {TASK_TIMEOUT:.0f})')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'worker':
+        run_worker(args.host, args.port)
+        return
+
+    # If output path not specified, create one based on input filename
+    if not args.output:
+        input_base = os.path.splitext(args.input_pdf)[0]
+        args.output = f"{input_base}_night_mode.pdf"
+
+    if not coordinate(args.input_pdf, args.output, args.workers, task_timeout=args.timeout):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import signal
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import fitz  # PyMuPDF
+import psutil
+
+# Seconds to wait for the server to answer /health after starting it
+STARTUP_TIMEOUT = 30
+# Seconds between server memory samples
+RSS_INTERVAL = 0.5
+# Seconds before a single HTTP request is considered failed
+REQUEST_TIMEOUT = 300
+
+# Generated corpus: name -> (pages, whether pages carry an incompressible image)
+# "large" exceeds the 2MB single-request limit and exercises the chunk endpoints
+CORPUS = {
+    "small": (1, False),
+    "medium": (8, False),
+    "large": (3, True),
+}
+
+def generate_pdf(pages, with_image):
+    """Create a test PDF with text and vector content, optionally with a noise image per page"""
+    doc = fitz.open()
+    for page_no in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Load test page {page_no + 1}", fontsize=24)
+        for line in range(40):
+            page.insert_text((72, 110 + line * 16), "The quick brown fox jumps over the lazy dog. " * 2, fontsize=9)
+        page.draw_rect(fitz.Rect(60, 60, 550, 780), color=(0.2, 0.2, 0.6), width=2)
+        if with_image:
+            # Random pixels do not compress, which keeps the file large
+            pix = fitz.Pixmap(fitz.csRGB, 800, 800, os.urandom(800 * 800 * 3), False)
+            page.insert_image(fitz.Rect(100, 300, 500, 700), pixmap=pix)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def encode_multipart(field_name, filename, data, fields=None):
+    """Encode a single file upload (and optional form fields) as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+        f'Content-Type: application/pdf\r\n\r\n'.encode()
+    )
+    parts.append(data)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def http_request(url, data=None, content_type=None):
+    """Perform a request, returning (status, content type, body)"""
+    request = urllib.request.Request(url, data=data)
+    if content_type:
+        request.add_header("Content-Type", content_type)
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return response.status, response.headers.get("Content-Type", ""), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get("Content-Type", ""), e.read()
+
+def post_json(url, payload):
+    status, _, body = http_request(url, json.dumps(payload).encode(), "application/json")
+    return status, json.loads(body or b"{}")
+
+class Recorder:
+    """Thread-safe collection of request timings"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []  # (endpoint, seconds, ok)
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.samples.append((endpoint, seconds, ok))
+
+def run_single_upload(base_url, name, data, recorder):
+    """Upload a small PDF to / and expect the converted PDF back"""
+    body, content_type = encode_multipart("file", f"{name}.pdf", data)
+    start = time.perf_counter()
+    try:
+        status, response_type, response = http_request(base_url + "/", body, content_type)
+        ok = status == 200 and response_type.startswith("application/pdf") and response.startswith(b"%PDF")
+    except Exception:
+        ok = False
+    recorder.record("POST /", time.perf_counter() - start, ok)
+    return ok
+
+def run_chunked_job(base_url, name, data, recorder):
+    """Upload a large PDF and drive the chunk endpoints the way chunks.html does"""
+    job_start = time.perf_counter()
+    ok = False
+    try:
+        body, content_type = encode_multipart("file", f"{name}.pdf", data)
+        start = time.perf_counter()
+        status, _, page = http_request(base_url + "/", body, content_type)
+        process_id = re.search(rb'const processId = "([0-9a-f-]+)"', page)
+        plan = re.search(rb"const chunkPlan = (\[.*?\]);", page, re.S)
+        recorder.record("POST / (chunked)", time.perf_counter() - start, bool(status == 200 and process_id and plan))
+        if not (process_id and plan):
+            return False
+        process_id = process_id.group(1).decode()
+        chunks = json.loads(plan.group(1))
+
+        for chunk in chunks:
+            start = time.perf_counter()
+            status, result = post_json(base_url + "/api/process-chunk", {
+                "process_id": process_id, "start_page": chunk["start"], "end_page": chunk["end"]})
+            chunk_ok = status == 200 and result.get("success", False)
+            recorder.record("POST /api/process-chunk", time.perf_counter() - start, chunk_ok)
+            if not chunk_ok:
+                return False
+
+        start = time.perf_counter()
+        status, result = post_json(base_url + "/api/combine-chunks", {
+            "process_id": process_id, "chunks": [f"{c['start']}_{c['end']}" for c in chunks]})
+        combine_ok = status == 200 and result.get("success", False)
+        recorder.record("POST /api/combine-chunks", time.perf_counter() - start, combine_ok)
+        if not combine_ok:
+            return False
+
+        start = time.perf_counter()
+        status, _, response = http_request(base_url + result["redirect"])
+        ok = status == 200 and response.startswith(b"%PDF")
+        recorder.record("GET /download", time.perf_counter() - start, ok)
+        return ok
+    except Exception:
+        return False
+    finally:
+        recorder.record("chunked job (end to end)", time.perf_counter() - job_start, ok)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(recorder, elapsed):
+    """Aggregate recorded samples per endpoint"""
+    summary = {}
+    endpoints = sorted({endpoint for endpoint, _, _ in recorder.samples})
+    for endpoint in endpoints + ["all requests"]:
+        if endpoint == "all requests":
+            samples = [s for s in recorder.samples if not s[0].endswith("(end to end)")]
+        else:
+            samples = [s for s in recorder.samples if s[0] == endpoint]
+        latencies = sorted(seconds for _, seconds, _ in samples)
+        errors = sum(1 for _, _, ok in samples if not ok)
+        summary[endpoint] = {
+            "count": len(samples),
+            "throughput": len(samples) / elapsed if elapsed > 0 else 0.0,
+            "error_rate": errors / len(samples) if samples else 0.0,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        }
+    return summary
+
+def sample_rss(pid, samples, stop_event, start_time):
+    """Record the total RSS of the server process and its children until stopped"""
+    try:
+        root = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return
+    while not stop_event.is_set():
+        try:
+            total = root.memory_info().rss
+            for child in root.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            samples.append((time.perf_counter() - start_time, total))
+        except psutil.NoSuchProcess:
+            return
+        stop_event.wait(RSS_INTERVAL)
+
+def start_server(server, port, workers):
+    """Start the app locally and wait until /health answers"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PORT=str(port))
+    if server == "gunicorn":
+        command = ["gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}", "--timeout", str(REQUEST_TIMEOUT), "app:app"]
+    else:
+        command = [sys.executable, "app.py"]
+
+    # A new session lets us stop the dev server's reloader child along with it
+    process = subprocess.Popen(command, cwd=app_dir, env=env, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            status, _, _ = http_request(f"http://127.0.0.1:{port}/health")
+            if status == 200:
+                return process
+        except OSError:
+            pass
+        time.sleep(0.25)
+
+    stop_server(process)
+    raise RuntimeError(f"Server did not become ready within {STARTUP_TIMEOUT} seconds")
+
+def stop_server(process):
+    """Stop the server and its workers; a server that already exited is not an error"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        # The whole process group is gone, only reap the server
+        process.poll()
+        return
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+def run_load(base_url, corpus, mix, concurrency, total_jobs):
+    """Run total_jobs jobs drawn round-robin from mix with the given concurrency"""
+    recorder = Recorder()
+    jobs = [mix[i % len(mix)] for i in range(total_jobs)]
+
+    def run_job(name):
+        if name == "large":
+            return run_chunked_job(base_url, name, corpus[name], recorder)
+        return run_single_upload(base_url, name, corpus[name], recorder)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_job, jobs))
+    return recorder, time.perf_counter() - start
+
+def print_report(summary, rss_samples, elapsed):
+    print(f"\nCompleted in {elapsed:.1f}s")
+    print(f"{'endpoint':<30} {'count':>6} {'req/s':>7} {'errors':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for endpoint, stats in summary.items():
+        print(f"{endpoint:<30} {stats['count']:>6} {stats['throughput']:>7.2f} {stats['error_rate']*100:>6.1f}% "
+              f"{stats['p50']:>7.2f}s {stats['p95']:>7.2f}s {stats['p99']:>7.2f}s")
+
+    if rss_samples:
+        peak = max(rss for _, rss in rss_samples) / (1024 * 1024)
+        final = rss_samples[-1][1] / (1024 * 1024)
+        print(f"\nServer RSS: start {rss_samples[0][1] / (1024 * 1024):.0f}MB, "
+              f"peak {peak:.0f}MB, end {final:.0f}MB ({len(rss_samples)} samples)")
+
+def check_thresholds(summary, rss_samples, args):
+    """Return a list of threshold violations for CI mode"""
+    overall = summary.get("all requests", {})
+    failures = []
+    if args.max_p95 is not None and overall.get("p95", 0) > args.max_p95:
+        failures.append(f"p95 latency {overall['p95']:.2f}s exceeds {args.max_p95:.2f}s")
+    if args.max_p99 is not None and overall.get("p99", 0) > args.max_p99:
+        failures.append(f"p99 latency {overall['p99']:.2f}s exceeds {args.max_p99:.2f}s")
+    if args.max_error_rate is not None and overall.get("error_rate", 0) > args.max_error_rate:
+        failures.append(f"error rate {overall['error_rate']:.3f} exceeds {args.max_error_rate:.3f}")
+    if args.min_throughput is not None and overall.get("throughput", 0) < args.min_throughput:
+        failures.append(f"throughput {overall['throughput']:.2f} req/s below {args.min_throughput:.2f}")
+    if args.max_rss_mb is not None and rss_samples:
+        peak = max(rss for _, rss in rss_samples) / (1024 * 1024)
+        if peak > args.max_rss_mb:
+            failures.append(f"peak RSS {peak:.0f}MB exceeds {args.max_rss_mb:.0f}MB")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the web app with concurrent PDF uploads')
+    parser.add_argument('--server', choices=['dev', 'gunicorn'], default='dev',
+                        help='Server to start locally (default: dev)')
+    parser.add_argument('--url', help='Test an already running server instead of starting one')
+    parser.add_argument('--server-pid', type=int, help='PID of the running server for RSS sampling with --url')
+    parser.add_argument('--port', type=int, default=5055, help='Port for the local server (default: 5055)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Gunicorn worker processes (default: 4)')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='Concurrent clients (default: 10)')
+    parser.add_argument('-n', '--jobs', type=int, default=50, help='Total upload jobs (default: 50)')
+    parser.add_argument('--mix', default='small,medium',
+                        help=f"Comma-separated corpus entries to cycle through ({', '.join(CORPUS)}; default: small,medium)")
+    parser.add_argument('--json', dest='json_path', help='Write the summary and RSS samples as JSON to this file')
+    parser.add_argument('--max-p95', type=float, help='Fail if overall p95 latency exceeds this many seconds')
+    parser.add_argument('--max-p99', type=float, help='Fail if overall p99 latency exceeds this many seconds')
+    parser.add_argument('--max-error-rate', type=float, help='Fail if the overall error rate exceeds this fraction')
+    parser.add_argument('--min-throughput', type=float, help='Fail if overall throughput is below this many requests/s')
+    parser.add_argument('--max-rss-mb', type=float, help='Fail if peak server RSS exceeds this many MB')
+
+    args = parser.parse_args()
+
+    mix = [name.strip() for name in args.mix.split(',') if name.strip()]
+    unknown = [name for name in mix if name not in CORPUS]
+    if unknown or not mix:
+        print(f"Unknown corpus entries: {', '.join(unknown) or '(none given)'}")
+        sys.exit(2)
+
+    print("Generating test corpus...")
+    corpus = {name: generate_pdf(*CORPUS[name]) for name in set(mix)}
+    for name, data in corpus.items():
+        print(f"  {name}: {len(data) / 1024:.0f}KB")
+
+    process = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        server_pid = args.server_pid
+    else:
+        print(f"Starting {args.server} server on port {args.port}...")
+        process = start_server(args.server, args.port, args.workers)
+        base_url = f"http://127.0.0.1:{args.port}"
+        server_pid = process.pid
+
+    rss_samples = []
+    stop_event = threading.Event()
+    sampler = None
+    if server_pid:
+        sampler = threading.Thread(target=sample_rss,
+                                   args=(server_pid, rss_samples, stop_event, time.perf_counter()),
+                                   daemon=True)
+        sampler.start()
+
+    try:
+        print(f"Running {args.jobs} jobs with {args.concurrency} concurrent clients against {base_url}...")
+        recorder, elapsed = run_load(base_url, corpus, mix, args.concurrency, args.jobs)
+    finally:
+        stop_event.set()
+        if sampler:
+            sampler.join()
+        if process:
+            stop_server(process)
+
+    summary = summarize(recorder, elapsed)
+    print_report(summary, rss_samples, elapsed)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"elapsed": elapsed, "summary": summary, "rss": rss_samples}, f, indent=2)
+
+    failures = check_thresholds(summary, rss_samples, args)
+    if failures:
+        print("\nThreshold check failed:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
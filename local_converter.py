@@ -3,52 +3,142 @@ import sys
 import fitz  # PyMuPDF
 from PIL import Image, ImageOps
 import argparse
+import contextlib
 import io
-import time
-import threading
-from concurrent.futures import ThreadPoolExecutor
-from pathlib import Path
+import math
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pdf_night_mode import (
+    classify_page,
+    append_night_mode_page,
+    PAGE_DARK,
+    PAGE_SCAN,
+    parse_device,
+    resolve_page_scale,
+    extract_page,
+    DEVICE_PRESETS,
+)
+from page_index import (
+    PageIndex,
+    page_fingerprint,
+    DEFAULT_INDEX_PATH,
+    DEFAULT_INDEX_MAX_BYTES,
+)
 
-def process_page(page, output_prefix, page_no, quality=80, scale=1.5):
-    """Process a single page to night mode"""
-    print(f"Processing page {page_no+1}...")
+# Pages rendering to more pixels than this are split into tiles
+TILE_THRESHOLD_PIXELS = 16 * 1024 * 1024
+# Maximum edge length of a tile in pixels, bounding per-tile memory
+TILE_SIZE = 2048
+
+def plan_page_tiles(page_rect, scale):
+    """Split a page into clip rectangles that each render within TILE_SIZE pixels"""
+    width_px = page_rect.width * scale
+    height_px = page_rect.height * scale
     
-    # Render at specified resolution
-    matrix = fitz.Matrix(scale, scale)
-    pix = page.get_pixmap(matrix=matrix, alpha=False)
+    # Normal pages are rendered in one piece
+    if width_px * height_px <= TILE_THRESHOLD_PIXELS:
+        return [fitz.Rect(page_rect)]
     
-    # Convert to PIL Image 
-    img_data = pix.tobytes("png")
-    img = Image.open(io.BytesIO(img_data))
+    # Tile edges are aligned to whole pixels so neighbouring tiles meet without seams
+    tile_points = TILE_SIZE / scale
+    cols = math.ceil(width_px / TILE_SIZE)
+    rows = math.ceil(height_px / TILE_SIZE)
+    
+    tiles = []
+    for row in range(rows):
+        y0 = page_rect.y0 + row * tile_points
+        y1 = min(y0 + tile_points, page_rect.y1)
+        for col in range(cols):
+            x0 = page_rect.x0 + col * tile_points
+            x1 = min(x0 + tile_points, page_rect.x1)
+            tiles.append(fitz.Rect(x0, y0, x1, y1))
+    return tiles
+
+# Input document of a tile worker process, opened once when the worker starts
+_worker_doc = None
+
+def _init_tile_worker(source):
+    """Open the input document, given as a path or PDF bytes, in a tile worker process"""
+    global _worker_doc
+    if isinstance(source, bytes):
+        _worker_doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        _worker_doc = fitz.open(source)
+
+def process_tile(page_no, clip, quality=90, scale=2.0):
+    """Render, invert and JPEG-encode one clip rectangle of a page in a tile worker process"""
+    # PyMuPDF holds the GIL while rendering and a document must not be shared
+    # between threads, so tiles are rendered in separate processes
+    page = _worker_doc[page_no]
+    
+    # Render only the requested area so memory is bounded by the tile size
+    matrix = fitz.Matrix(scale, scale)
+    pix = page.get_pixmap(matrix=matrix, clip=fitz.Rect(clip), alpha=False)
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
     
     # Free pixmap resources
     pix = None
     
     # Invert the image
-    img_inverted = ImageOps.invert(img.convert("RGB"))
-    
-    # Close original image
+    img_inverted = ImageOps.invert(img)
     img.close()
     
-    # Return the inverted image and page dimensions
-    return img_inverted, page.rect.width, page.rect.height
+    # Encode in the worker so only compressed data is kept until the page is assembled
+    buffer = io.BytesIO()
+    img_inverted.save(buffer, format="JPEG", quality=quality)
+    img_inverted.close()
+    
+    return buffer.getvalue()
 
-def convert_to_night_mode(input_path, output_path, quality=90, scale=2.0, max_workers=4):
-    """Convert a PDF to night mode using multithreading for speed"""
+def open_cached_page(index, fingerprint):
+    """Open the converted page stored in the index for a fingerprint, or return None"""
+    data = index.get(fingerprint)
+    if data is None:
+        return None
+    
+    try:
+        doc_cached = fitz.open(stream=data, filetype="pdf")
+    except Exception:
+        doc_cached = None
+    if doc_cached is None or doc_cached.page_count != 1:
+        # Unreadable entries are dropped so the page is converted and stored again
+        if doc_cached is not None:
+            doc_cached.close()
+        index.discard(fingerprint)
+        return None
+    return doc_cached
+
+def convert_to_night_mode(input_path, output_path, quality=90, scale=2.0, max_workers=4, device=None, dpi=None,
+                          index=None):
+    """
+    Convert a PDF to night mode, rendering pages and tiles in parallel worker processes
+    
+    input_path and output_path may also be binary file objects, e.g. for piping
+    through stdin and stdout. If a target device (preset name or viewport width
+    in pixels) or DPI is given, each page is rendered at the resolution that
+    suits it instead of at the fixed scale. If a PageIndex is given, pages
+    converted before with the same content and settings are taken from it and
+    newly converted pages are added to it.
+    """
+    input_is_stream = hasattr(input_path, "read")
+    output_is_stream = hasattr(output_path, "write")
+    
     # Check if input file exists
-    if not os.path.exists(input_path):
+    if not input_is_stream and not os.path.exists(input_path):
         print(f"Error: Input file '{input_path}' not found")
         return False
-        
-    # Get base filename for temp files
-    temp_prefix = f"temp_{int(time.time())}"
     
     try:
-        print(f"Opening PDF: {input_path}")
+        print(f"Opening PDF: {'<stdin>' if input_is_stream else input_path}")
         print(f"This may take a while depending on the PDF size...")
         
-        # Open the input document
-        doc_in = fitz.open(input_path)
+        # Open the input document; worker processes open their own copy from the same source
+        if input_is_stream:
+            worker_source = input_path.read()
+            doc_in = fitz.open(stream=worker_source, filetype="pdf")
+        else:
+            worker_source = input_path
+            doc_in = fitz.open(input_path)
         total_pages = len(doc_in)
         print(f"PDF has {total_pages} pages")
         
@@ -59,54 +149,121 @@ def convert_to_night_mode(input_path, output_path, quality=90, scale=2.0, max_wo
         completed = 0
         print("Starting parallel processing of pages with high quality settings...")
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(process_page, doc_in[page_no], temp_prefix, page_no, quality, scale): 
-                page_no for page_no in range(total_pages)
-            }
+        # The worker pool is only started once a page needs rendering
+        executor = None
+        with contextlib.ExitStack() as stack:
+            def submit_tiles(page, page_scale):
+                nonlocal executor
+                if executor is None:
+                    executor = stack.enter_context(ProcessPoolExecutor(
+                        max_workers=max_workers, initializer=_init_tile_worker, initargs=(worker_source,)
+                    ))
+                
+                # Oversized pages are split into tiles so a single page can use several workers
+                tiles = plan_page_tiles(page.rect, page_scale)
+                if len(tiles) > 1:
+                    print(f"Page {page.number+1} is oversized, rendering as {len(tiles)} tiles")
+                return [
+                    (clip, executor.submit(process_tile, page.number, tuple(clip), quality, page_scale))
+                    for clip in tiles
+                ]
+            
+            page_tiles = {}
+            page_classes = {}
+            page_cached = set()
+            page_fingerprints = {}
+            fingerprint_memo = {}
+            for page_no in range(total_pages):
+                page = doc_in[page_no]
+                page_scale = resolve_page_scale(page.rect, scale, device, dpi)
+                
+                # Unchanged pages are spliced in from the index without converting them again;
+                # they are only read from it when the page is assembled
+                if index is not None:
+                    fingerprint = page_fingerprint(doc_in, page, {"scale": page_scale, "quality": quality},
+                                                   fingerprint_memo)
+                    page_fingerprints[page_no] = fingerprint
+                    if index.contains(fingerprint):
+                        page_cached.add(page_no)
+                        continue
+                
+                # Dark pages and scans are converted without rendering when the page is assembled
+                page_classes[page_no] = classify_page(page)
+                kind = page_classes[page_no][0]
+                if kind == PAGE_DARK:
+                    print(f"Page {page_no+1} is already dark, copying unchanged")
+                elif kind == PAGE_SCAN:
+                    print(f"Page {page_no+1} is a scan, inverting its image at native resolution")
+                else:
+                    page_tiles[page_no] = submit_tiles(page, page_scale)
             
-            # As each page completes, add it to the output PDF
-            for i, future in enumerate(futures):
-                # Get page info and inverted image
+            if index is not None:
+                print(f"Reusing {len(page_cached)} of {total_pages} pages from the page index")
+            
+            def render_tiles(page, display_list):
+                # Scans whose fast path failed have no tiles yet and are rendered now
+                tiles = page_tiles.pop(page.number, None)
+                if tiles is None:
+                    tiles = submit_tiles(page, resolve_page_scale(page.rect, scale, device, dpi))
+                
+                # Collect every tile before creating the page so a failed page is skipped entirely
+                tile_images = [(clip, future.result()) for clip, future in tiles]
+                
+                # Create a new page with black background
+                new_page = doc_out.new_page(width=page.rect.width, height=page.rect.height)
+                shape = new_page.new_shape()
+                shape.draw_rect(new_page.rect)
+                shape.finish(fill=(0, 0, 0))
+                shape.commit()
+                
+                # Add inverted tiles to the page
+                for clip, image_data in tile_images:
+                    new_page.insert_image(clip, stream=image_data, keep_proportion=False)
+            
+            def store_page(page_no):
+                # Add the page just appended to the output to the index
+                if page_no in page_fingerprints:
+                    index.put(page_fingerprints[page_no], extract_page(doc_out, doc_out.page_count - 1))
+            
+            # Assemble pages in order as their tiles complete
+            for page_no in range(total_pages):
                 try:
-                    inverted_img, width, height = future.result()
-                    page_no = futures[future]
-                    
-                    # Create a new page with black background
-                    new_page = doc_out.new_page(width=width, height=height)
-                    shape = new_page.new_shape()
-                    shape.draw_rect(new_page.rect)
-                    shape.finish(fill=(0, 0, 0))
-                    shape.commit()
-                    
-                    # Save inverted image to temp file
-                    temp_img_path = f"{temp_prefix}_{page_no}.jpg"
-                    inverted_img.save(temp_img_path, format="JPEG", quality=quality)
+                    doc_cached = None
+                    if page_no in page_cached:
+                        doc_cached = open_cached_page(index, page_fingerprints[page_no])
                     
-                    # Add inverted image to page
-                    new_page.insert_image(new_page.rect, filename=temp_img_path)
-                    
-                    # Clean up
-                    try:
-                        os.remove(temp_img_path)
-                    except Exception as e:
-                        print(f"Warning: Could not remove temp file {temp_img_path}: {e}")
-                    
-                    # Free memory
-                    inverted_img.close()
+                    if doc_cached is not None:
+                        doc_out.insert_pdf(doc_cached)
+                        doc_cached.close()
+                    else:
+                        # Pages evicted from the index since planning are classified here
+                        append_night_mode_page(doc_out, doc_in, page_no, scale, quality, device, dpi,
+                                               render=render_tiles, classification=page_classes.pop(page_no, None))
+                        store_page(page_no)
                     
                     # Progress indication
                     completed += 1
                     print(f"Completed: {completed}/{total_pages} pages ({(completed/total_pages*100):.1f}%)")
                     
                 except Exception as e:
-                    print(f"Error processing page {futures[future]+1}: {str(e)}")
+                    # Free the tiles of a failed page
+                    page_tiles.pop(page_no, None)
+                    print(f"Error processing page {page_no+1}: {str(e)}")
         
         # Check if we have any pages
         if doc_out.page_count == 0:
             print("Error: No pages were successfully processed")
             return False
             
+        # Write to the output stream
+        if output_is_stream:
+            print("Writing output PDF to stream...")
+            output_path.write(doc_out.tobytes(garbage=4, deflate=True, clean=True))
+            output_path.flush()
+            doc_out.close()
+            doc_in.close()
+            return True
+        
         # Save the output file
         print(f"Saving to {output_path}...")
         doc_out.save(output_path, garbage=4, deflate=True, clean=True)
@@ -123,28 +280,30 @@ def convert_to_night_mode(input_path, output_path, quality=90, scale=2.0, max_wo
     except Exception as e:
         print(f"Error converting PDF: {e}")
         return False
-    
-    finally:
-        # Clean up any remaining temp files
-        for tmp_file in Path('.').glob(f"{temp_prefix}_*.jpg"):
-            try:
-                os.remove(tmp_file)
-            except:
-                pass
 
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Convert PDF to night mode (dark background with light text)')
-    parser.add_argument('input_pdf', help='Path to the input PDF file')
-    parser.add_argument('-o', '--output', help='Path to save the night mode PDF (default: adds _night_mode suffix)')
+    parser.add_argument('input_pdf', help='Path to the input PDF file, or - to read from stdin')
+    parser.add_argument('-o', '--output', help='Path to save the night mode PDF, or - to write to stdout (default: adds _night_mode suffix, stdout when reading stdin)')
     parser.add_argument('-q', '--quality', type=int, default=90, help='Image quality (1-100, default: 90)')
     parser.add_argument('-s', '--scale', type=float, default=2.0, help='Resolution scale factor (default: 2.0)')
-    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of processing threads (default: 4)')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of worker processes rendering pages (default: 4)')
+    parser.add_argument('-d', '--device', type=parse_device,
+                        help=f"Target reading device ({', '.join(DEVICE_PRESETS)}) or viewport width in pixels; overrides --scale")
+    parser.add_argument('--dpi', type=float, help='Target resolution in dots per inch; overrides --scale and --device')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Reuse pages converted before with the same content and settings from a page index')
+    parser.add_argument('--index', help=f'Path of the page index; implies --incremental (default: {DEFAULT_INDEX_PATH})')
+    parser.add_argument('--index-size', type=int, default=DEFAULT_INDEX_MAX_BYTES // (1024 * 1024),
+                        help=f'Maximum size of the page index in MB (default: {DEFAULT_INDEX_MAX_BYTES // (1024 * 1024)})')
     
     args = parser.parse_args()
     
     # If output path not specified, create one based on input filename
-    if not args.output:
+    if not args.output and args.input_pdf == '-':
+        args.output = '-'
+    elif not args.output:
         input_base = os.path.splitext(args.input_pdf)[0]
         args.output = f"{input_base}_night_mode.pdf"
     
@@ -163,17 +322,50 @@ def main():
         print("Threads must be at least 1")
         return
     
-    print("Converting with high quality settings: scale=%.1f, quality=%d, threads=%d" % 
-          (args.scale, args.quality, args.threads))
+    # Validate DPI
+    if args.dpi is not None and args.dpi <= 0:
+        print("DPI must be greater than 0")
+        return
+    
+    # Validate index size
+    if args.index_size < 1:
+        print("Index size must be at least 1 MB")
+        return
+    
+    # Use the binary stdin/stdout streams for "-"; progress messages then go to stderr
+    input_source = sys.stdin.buffer if args.input_pdf == '-' else args.input_pdf
+    output_target = sys.stdout.buffer if args.output == '-' else args.output
+    
+    # Open the page index for incremental conversion
+    index = None
+    if args.incremental or args.index:
+        try:
+            index = PageIndex(args.index or DEFAULT_INDEX_PATH, max_bytes=args.index_size * 1024 * 1024)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: page index unavailable ({e}), converting every page", file=sys.stderr)
+    
+    with contextlib.redirect_stdout(sys.stderr if args.output == '-' else sys.stdout):
+        print("Converting with high quality settings: scale=%.1f, quality=%d, threads=%d" % 
+              (args.scale, args.quality, args.threads))
         
-    # Convert the PDF
-    convert_to_night_mode(
-        args.input_pdf, 
-        args.output, 
-        quality=args.quality, 
-        scale=args.scale,
-        max_workers=args.threads
-    )
+        try:
+            # Convert the PDF
+            success = convert_to_night_mode(
+                input_source, 
+                output_target, 
+                quality=args.quality, 
+                scale=args.scale,
+                max_workers=args.threads,
+                device=args.device,
+                dpi=args.dpi,
+                index=index
+            )
+        finally:
+            if index is not None:
+                index.close()
+    
+    if not success:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Default location of the page index shared by all incremental conversions
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pdf_night_mode", "page_index.sqlite")
+# Limits of the index; least recently used pages are evicted beyond them
+DEFAULT_INDEX_MAX_BYTES = 1024 * 1024 * 1024  # Total size of the stored page fragments
+DEFAULT_INDEX_MAX_PAGES = 100000
+# Seconds to wait for another process holding the index before giving up on an operation
+INDEX_LOCK_TIMEOUT = 5.0
+# Part of every fingerprint; bump when converted pages change for the same settings
+FINGERPRINT_VERSION = 1
+
+# Indirect object references in PDF object source, e.g. "12 0 R"
+_REFERENCE = re.compile(rb"(\d+)\s+(\d+)\s+R\b")
+# Back-references to the page tree or the owning page, which would make every
+# resource depend on every page of the document
+_BACK_REFERENCE = re.compile(rb"/(?:Parent|P)\s+\d+\s+\d+\s+R\b")
+
+def _object_digest(doc, xref, memo):
+    """
+    Hash an object and everything it references
+
+    References are replaced by the digest of the object they point to, so the
+    result depends on the content of the object graph and not on xref numbers,
+    which change whenever a document is rewritten.
+    """
+    if xref in memo:
+        return memo[xref]
+    # Placeholder for reference cycles
+    memo[xref] = b"cycle"
+
+    digest = hashlib.sha256()
+    source = doc.xref_object(xref, compressed=True).encode("latin-1", "replace")
+    digest.update(_digest_source(doc, source, memo))
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref))
+
+    memo[xref] = digest.digest()
+    return memo[xref]
+
+def _digest_source(doc, source, memo):
+    """Replace the references in PDF object source by the digests of their objects"""
+    xref_count = doc.xref_length()
+
+    def replace(match):
+        xref = int(match.group(1))
+        if not 0 < xref < xref_count:
+            return match.group(0)
+        return _object_digest(doc, xref, memo).hex().encode("ascii")
+
+    return _REFERENCE.sub(replace, _BACK_REFERENCE.sub(b"", source))
+
+def _inherited_key(doc, xref, key):
+    """Look up a page key, following the page tree for inheritable keys such as /Resources"""
+    while xref > 0:
+        kind, value = doc.xref_get_key(xref, key)
+        if kind != "null":
+            return value
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        xref = int(parent.split()[0]) if kind == "xref" else 0
+    return "null"
+
+def page_fingerprint(doc, page, settings, memo=None):
+    """
+    Fingerprint everything that determines how a page is converted
+
+    The fingerprint covers the decompressed content streams, a digest of the
+    resources and annotations with every object they reference, the page
+    geometry and the conversion settings (a JSON-serializable dict). Pass the
+    same memo dict for all pages of a document so shared resources such as
+    fonts are hashed once.
+    """
+    if memo is None:
+        memo = {}
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "version": FINGERPRINT_VERSION,
+        "settings": settings,
+        "rect": list(page.rect),
+        "mediabox": list(page.mediabox),
+        "cropbox": list(page.cropbox),
+        "rotation": page.rotation,
+    }, sort_keys=True).encode("utf-8"))
+
+    for xref in page.get_contents():
+        digest.update(b"contents")
+        digest.update(doc.xref_stream(xref) or b"")
+
+    for key in ("Resources", "Annots"):
+        source = _inherited_key(doc, page.xref, key).encode("latin-1", "replace")
+        digest.update(key.encode("ascii"))
+        digest.update(_digest_source(doc, source, memo))
+
+    return digest.hexdigest()
+
+class PageIndex:
+    """
+    On-disk index mapping page fingerprints to converted single-page PDFs
+
+    Several conversions may share one index. Every write is a short
+    transaction of its own, and an operation that cannot get the index within
+    INDEX_LOCK_TIMEOUT is skipped, so contention costs a cache miss rather than
+    a failed conversion. Entries are evicted least recently used first once the
+    index exceeds max_bytes or max_pages when it is closed.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, max_bytes=DEFAULT_INDEX_MAX_BYTES,
+                 max_pages=DEFAULT_INDEX_MAX_PAGES):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        # Access times of pages read from the index, written back in one transaction on close
+        self.used = {}
+        # Autocommit mode, so no statement leaves a transaction open
+        self.connection = sqlite3.connect(path, timeout=INDEX_LOCK_TIMEOUT, isolation_level=None)
+        # Readers do not block the writer and the writer does not block readers
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "fingerprint TEXT PRIMARY KEY, data BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+
+    def contains(self, fingerprint):
+        """Check whether a page is stored, without reading it or marking it used"""
+        try:
+            row = self.connection.execute(
+                "SELECT 1 FROM pages WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Page index lookup failed: {e}")
+            return False
+        return row is not None
+
+    def get(self, fingerprint):
+        """Return the converted page stored for a fingerprint, or None"""
+        try:
+            row = self.connection.execute(
+                "SELECT data FROM pages WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Page index lookup failed: {e}")
+            return None
+        if row is None:
+            return None
+        self.used[fingerprint] = time.time()
+        return row[0]
+
+    def put(self, fingerprint, data):
+        """Store a converted page; pages larger than the whole index are not stored"""
+        if len(data) > self.max_bytes:
+            return
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages (fingerprint, data, size, last_used) VALUES (?, ?, ?, ?)",
+                (fingerprint, sqlite3.Binary(data), len(data), time.time())
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Could not store page in the index: {e}")
+
+    def discard(self, fingerprint):
+        """Remove a page, e.g. one whose stored data could not be opened"""
+        self.used.pop(fingerprint, None)
+        try:
+            self.connection.execute("DELETE FROM pages WHERE fingerprint = ?", (fingerprint,))
+        except sqlite3.Error as e:
+            logger.warning(f"Could not remove page from the index: {e}")
+
+    def _evict(self):
+        """Delete least recently used pages until the index is within its limits"""
+        total_pages, total_bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages"
+        ).fetchone()
+        if total_pages <= self.max_pages and total_bytes <= self.max_bytes:
+            return 0
+
+        evicted = []
+        rows = self.connection.execute("SELECT fingerprint, size FROM pages ORDER BY last_used").fetchall()
+        for fingerprint, size in rows:
+            if total_pages <= self.max_pages and total_bytes <= self.max_bytes:
+                break
+            evicted.append((fingerprint,))
+            total_pages -= 1
+            total_bytes -= size
+
+        self.connection.executemany("DELETE FROM pages WHERE fingerprint = ?", evicted)
+        return len(evicted)
+
+    def close(self):
+        """Record page access times, apply the size limits and close the index"""
+        if self.connection is None:
+            return
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "UPDATE pages SET last_used = ? WHERE fingerprint = ?",
+                    [(used, fingerprint) for fingerprint, used in self.used.items()]
+                )
+                self._evict()
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning(f"Could not update the page index: {e}")
+        self.connection.close()
+        self.connection = None
+        self.used = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
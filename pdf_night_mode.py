@@ -4,13 +4,587 @@ import sys
 import argparse
 import traceback
 import logging
-from PIL import Image, ImageOps
+from PIL import Image, ImageChops, ImageOps
 import io
+import math
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def convert_pdf_to_night_mode(input_path, output_path):
+# Limits of the process-wide cache of open input documents
+DOCUMENT_CACHE_MAX_HANDLES = 8
+DOCUMENT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Total size of the cached PDF files
+
+# Cache entries keyed by (absolute path, mtime, size), least recently used first
+_document_cache = OrderedDict()
+_document_cache_lock = threading.Lock()
+
+def _close_cache_entry(entry):
+    if entry["doc"] is not None:
+        entry["doc"].close()
+        entry["doc"] = None
+
+def _release_cache_entry(key):
+    """Remove an entry from the cache, closing it now or when its last user returns it"""
+    entry = _document_cache.pop(key)
+    entry["evicted"] = True
+    if entry["users"] == 0:
+        _close_cache_entry(entry)
+
+def _trim_document_cache():
+    """Evict idle entries, least recently used first, until the cache is within its limits"""
+    total_bytes = sum(entry["size"] for entry in _document_cache.values())
+    for key in list(_document_cache):
+        if len(_document_cache) <= DOCUMENT_CACHE_MAX_HANDLES and total_bytes <= DOCUMENT_CACHE_MAX_BYTES:
+            break
+        entry = _document_cache[key]
+        if entry["users"] == 0:
+            total_bytes -= entry["size"]
+            _release_cache_entry(key)
+
+@contextmanager
+def checkout_document(input_path):
+    """
+    Open a PDF through the process-wide cache of open documents
+    
+    Repeated requests for the same file (e.g. the chunks of one upload) reuse
+    the parsed document instead of reading the xref and page tree again.
+    Entries are keyed by path, modification time and size, so a changed file
+    is reopened. The document is locked for the duration of the with block
+    because PyMuPDF documents must not be used by two threads at once.
+    
+    Args:
+        input_path: Path to the PDF file
+    
+    Yields:
+        fitz.Document: The open document; do not close it
+    """
+    stat = os.stat(input_path)
+    path = os.path.abspath(input_path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    
+    with _document_cache_lock:
+        # Drop entries for older versions of the same file
+        for stale_key in [k for k in _document_cache if k[0] == path and k != key]:
+            _release_cache_entry(stale_key)
+        
+        entry = _document_cache.get(key)
+        if entry is None:
+            entry = {"doc": None, "lock": threading.Lock(), "size": stat.st_size, "users": 0, "evicted": False}
+            _document_cache[key] = entry
+        _document_cache.move_to_end(key)
+        entry["users"] += 1
+    
+    try:
+        with entry["lock"]:
+            # Open outside the cache lock so other documents are not blocked
+            if entry["doc"] is None:
+                logger.info(f"Opening {path} into document cache")
+                entry["doc"] = fitz.open(path)
+            yield entry["doc"]
+    finally:
+        with _document_cache_lock:
+            entry["users"] -= 1
+            if entry["evicted"] and entry["users"] == 0:
+                _close_cache_entry(entry)
+            _trim_document_cache()
+
+def invalidate_document(input_path):
+    """Remove all cached versions of a file, e.g. before deleting it"""
+    path = os.path.abspath(input_path)
+    with _document_cache_lock:
+        for key in [k for k in _document_cache if k[0] == path]:
+            _release_cache_entry(key)
+
+def clear_document_cache():
+    """Remove every document from the cache; documents in use are closed when returned"""
+    with _document_cache_lock:
+        for key in list(_document_cache):
+            _release_cache_entry(key)
+
+# Longest edge in pixels of the thumbnail used to detect already-dark pages
+DARK_CHECK_SIZE = 64
+# Luminance (0-255) below which a thumbnail pixel counts as dark
+DARK_PIXEL_LUMINANCE = 80
+# Fraction of dark thumbnail pixels needed for a page to be passed through unchanged
+DARK_PAGE_RATIO = 0.9
+
+def is_dark_page(page, display_list=None):
+    """
+    Check whether a page already has a dark background
+    
+    Renders a small grayscale thumbnail and inspects its luminance histogram,
+    so the check costs a fraction of a full render.
+    
+    Args:
+        page: The fitz.Page to check
+        display_list: Optional display list of the page to render from instead of the page
+    
+    Returns:
+        bool: True if the page is already dark
+    """
+    scale = DARK_CHECK_SIZE / max(page.rect.width, page.rect.height, 1)
+    matrix = fitz.Matrix(scale, scale)
+    source = display_list if display_list is not None else page
+    pix = source.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False)
+    
+    histogram = Image.frombytes("L", (pix.width, pix.height), pix.samples).histogram()
+    total = sum(histogram)
+    if total == 0:
+        return False
+    
+    dark_pixels = sum(histogram[:DARK_PIXEL_LUMINANCE])
+    return dark_pixels / total >= DARK_PAGE_RATIO
+
+# Minimum fraction of the page a single image must cover for the page to count as a scan
+SCAN_COVERAGE = 0.95
+
+def find_scanned_image(page):
+    """
+    Find the single embedded image that makes up a scanned page
+    
+    A page counts as scanned if it draws exactly one image, upright and
+    covering nearly the whole page, with no vector drawings and no visible
+    text (invisible OCR text layers are allowed).
+    
+    Args:
+        page: The fitz.Page to check
+    
+    Returns:
+        tuple: (xref, bbox) of the image, bbox being its full placement on the
+        page, or None if the page is not a scan
+    """
+    # Cheapest checks first: most pages fail on the image list alone
+    if page.rotation != 0:
+        return None
+    images = page.get_images(full=True)
+    if len(images) != 1 or images[0][1] != 0:  # Exactly one image, without soft mask
+        return None
+    
+    infos = page.get_image_info(xrefs=True)
+    if len(infos) != 1 or infos[0]["xref"] != images[0][0]:
+        return None
+    
+    # Only plain scaling and translation; rotated or flipped placement is rendered instead
+    a, b, c, d, e, f = infos[0]["transform"]
+    if b != 0 or c != 0 or a <= 0 or d <= 0:
+        return None
+    
+    # Coverage counts only the visible part, but the full placement is returned
+    # so the image keeps its proportions and the page crops what lies outside
+    bbox = fitz.Rect(infos[0]["bbox"])
+    visible = bbox & page.rect
+    if visible.is_empty or visible.get_area() < SCAN_COVERAGE * page.rect.get_area():
+        return None
+    
+    # Anything drawn on top of the scan would be lost
+    if page.get_drawings():
+        return None
+    if any(span["type"] != 3 for span in page.get_texttrace()):  # Type 3 is invisible text
+        return None
+    
+    return images[0][0], bbox
+
+def _append_inverted_scan(doc_out, doc_in, page, xref, bbox, quality):
+    """
+    Append a scanned page with its image inverted at native resolution
+    
+    RGB and grayscale JPEGs are copied unchanged and inverted through the
+    image's /Decode array, so they are neither decoded nor re-encoded. Other
+    images are decoded, inverted and re-embedded at their original size.
+    """
+    image = doc_in.extract_image(xref)
+    if image["colorspace"] not in (1, 3):
+        raise ValueError(f"Unsupported image colorspace with {image['colorspace']} components")
+    
+    # Create a new page with black background
+    new_page = doc_out.new_page(width=page.rect.width, height=page.rect.height)
+    shape = new_page.new_shape()
+    shape.draw_rect(new_page.rect)
+    shape.finish(fill=(0, 0, 0))
+    shape.commit()
+    
+    has_decode = doc_in.xref_get_key(xref, "Decode")[0] != "null"
+    if image["ext"] in ("jpeg", "jpg") and not has_decode:
+        new_xref = new_page.insert_image(bbox, stream=image["image"], keep_proportion=False)
+        doc_out.xref_set_key(new_xref, "Decode", "[" + " ".join(["1 0"] * image["colorspace"]) + "]")
+        return
+    
+    img = Image.open(io.BytesIO(image["image"]))
+    if img.mode not in ("1", "L", "RGB"):
+        img = img.convert("RGB")
+    img_inverted = ImageChops.invert(img)
+    img.close()
+    
+    # Keep JPEG sources lossy and everything else (bilevel, flate) lossless
+    buffer = io.BytesIO()
+    if image["ext"] in ("jpeg", "jpg"):
+        img_inverted.save(buffer, format="JPEG", optimize=True, quality=quality)
+    else:
+        img_inverted.save(buffer, format="PNG", optimize=True)
+    img_inverted.close()
+    
+    new_page.insert_image(bbox, stream=buffer.getvalue(), keep_proportion=False)
+
+def append_inverted_scan(doc_out, doc_in, page, quality, scan=None):
+    """
+    Use the scanned-page fast path if the page is a scan
+    
+    Args:
+        doc_out: The output fitz.Document
+        doc_in: The input fitz.Document the page belongs to
+        page: The fitz.Page to convert
+        quality: JPEG quality for scans that have to be re-encoded
+        scan: Result of find_scanned_image if already known
+    
+    Returns:
+        bool: True if the page was appended, False if it needs to be rendered
+    """
+    if scan is None:
+        scan = find_scanned_image(page)
+    if scan is None:
+        return False
+    
+    page_count = doc_out.page_count
+    try:
+        _append_inverted_scan(doc_out, doc_in, page, scan[0], scan[1], quality)
+        return True
+    except Exception as e:
+        logger.warning(f"Scanned page fast path failed for page {page.number+1}, rendering instead: {e}")
+        # Drop a partially built page before falling back
+        if doc_out.page_count > page_count:
+            doc_out.delete_page(-1)
+        return False
+
+# Viewport widths in pixels of typical reading devices, pages are fitted to the width
+DEVICE_PRESETS = {
+    "phone": 1080,
+    "e-reader": 1264,
+    "tablet": 1600,
+    "desktop": 1920,
+}
+# Bounds for device-derived render scales
+MIN_DEVICE_SCALE = 0.5
+MAX_DEVICE_SCALE = 4.0
+
+def parse_device(value):
+    """
+    Parse a target device given as a preset name or a viewport width in pixels
+    
+    Raises:
+        argparse.ArgumentTypeError: If the value is neither a known preset nor a positive width
+    """
+    if isinstance(value, int) or str(value).isdigit():
+        width = int(value)
+        if width <= 0:
+            raise argparse.ArgumentTypeError("Viewport width must be greater than 0")
+        return width
+    if value not in DEVICE_PRESETS:
+        raise argparse.ArgumentTypeError(f"Unknown device '{value}', expected one of {', '.join(DEVICE_PRESETS)} or a width in pixels")
+    return value
+
+def resolve_page_scale(page_rect, scale, device=None, dpi=None):
+    """
+    Compute the render scale for a page from the reading target
+    
+    With a device, the page is rendered just wide enough to fill the device's
+    viewport width pixel for pixel, which is the smallest resolution that
+    still looks sharp there. A DPI gives a fixed physical resolution instead.
+    Without either, the given scale is used unchanged.
+    
+    Args:
+        page_rect: The page rectangle in points
+        scale: Fallback scale factor
+        device: Preset name from DEVICE_PRESETS or viewport width in pixels
+        dpi: Target resolution in dots per inch
+    
+    Returns:
+        float: The render scale factor
+    """
+    if dpi:
+        return dpi / 72.0
+    if device is None:
+        return scale
+    
+    viewport_width = DEVICE_PRESETS[device] if isinstance(device, str) else device
+    device_scale = viewport_width / max(page_rect.width, 1)
+    return min(MAX_DEVICE_SCALE, max(MIN_DEVICE_SCALE, device_scale))
+
+# Render scale and JPEG quality for chunked processing, independent of chunk boundaries
+CHUNK_SCALE = 1.5
+CHUNK_QUALITY = 85
+# Processing time budget in seconds for one chunk (serverless time limit with headroom)
+CHUNK_TIME_BUDGET = 7.0
+
+# Page cost model coefficients in seconds
+PAGE_BASE_COST = 0.02  # Fixed per-page overhead (page load, new page, insert)
+MEGAPIXEL_COST = 0.12  # Render, invert and JPEG-encode one rendered megapixel
+CONTENT_BYTE_COST = 0.4e-6  # Interpret one byte of decompressed content stream
+IMAGE_COST = 0.05  # Decode one embedded image
+
+def estimate_page_cost(page, device=None):
+    """
+    Estimate the time in seconds needed to convert a page in a chunk
+    
+    Uses the page area at the scale the page will be rendered at, the content
+    stream length and the number of embedded images, all of which are cheap to
+    read without rendering.
+    
+    Args:
+        page: The fitz.Page to estimate
+        device: Optional target device the chunk is rendered for (see resolve_page_scale)
+    
+    Returns:
+        float: Estimated processing time in seconds
+    """
+    scale = resolve_page_scale(page.rect, CHUNK_SCALE, device)
+    megapixels = page.rect.width * page.rect.height * scale * scale / 1e6
+    content_length = len(page.read_contents())
+    image_count = len(page.get_images())
+    
+    return (PAGE_BASE_COST
+            + megapixels * MEGAPIXEL_COST
+            + content_length * CONTENT_BYTE_COST
+            + image_count * IMAGE_COST)
+
+def plan_chunks(doc_in, time_budget=CHUNK_TIME_BUDGET, device=None):
+    """
+    Split a document into page ranges of roughly equal processing time
+    
+    The number of chunks is the smallest that keeps the average chunk under
+    time_budget, and pages are then grouped greedily towards that average. A
+    chunk is also closed early if the next page would push it over the budget;
+    a single page that exceeds the budget on its own gets a chunk of its own.
+    
+    Args:
+        doc_in: The open input fitz.Document
+        time_budget: Maximum estimated processing time per chunk in seconds
+        device: Optional target device the chunks are rendered for
+    
+    Returns:
+        list: One dict per chunk with 'start', 'end' (exclusive) and estimated 'cost'
+    """
+    costs = [estimate_page_cost(doc_in[page_no], device) for page_no in range(len(doc_in))]
+    if not costs:
+        return []
+    
+    total_cost = sum(costs)
+    target = total_cost / max(1, math.ceil(total_cost / time_budget))
+    
+    chunks = []
+    start = 0
+    chunk_cost = 0.0
+    for page_no, cost in enumerate(costs):
+        # Close the current chunk if this page would push it over the budget
+        if page_no > start and chunk_cost + cost > time_budget:
+            chunks.append({"start": start, "end": page_no, "cost": round(chunk_cost, 2)})
+            start = page_no
+            chunk_cost = 0.0
+        
+        chunk_cost += cost
+        
+        # Close the chunk once it has reached its share of the total
+        if chunk_cost >= target:
+            chunks.append({"start": start, "end": page_no + 1, "cost": round(chunk_cost, 2)})
+            start = page_no + 1
+            chunk_cost = 0.0
+    
+    if start < len(costs):
+        chunks.append({"start": start, "end": len(costs), "cost": round(chunk_cost, 2)})
+    
+    logger.info(f"Planned {len(chunks)} chunks for {len(costs)} pages, estimated {total_cost:.1f}s total")
+    return chunks
+
+def plan_pdf_chunks(input_path, time_budget=CHUNK_TIME_BUDGET, device=None):
+    """
+    Plan the chunks for a PDF file, see plan_chunks
+    
+    Returns:
+        list: The chunk plan, or None if the file could not be read
+    """
+    try:
+        # Planning warms the document cache for the chunk requests that follow
+        with checkout_document(input_path) as doc_in:
+            return plan_chunks(doc_in, time_budget, device)
+    except Exception as e:
+        logger.error(f"Error planning chunks for {input_path}: {e}")
+        logger.error(traceback.format_exc())
+        return None
+
+def _render_inverted_image(display_list, scale, quality):
+    """Render a page from its display list, invert it and return it as JPEG bytes"""
+    matrix = fitz.Matrix(scale, scale)
+    pix = display_list.get_pixmap(matrix=matrix, alpha=False)
+    
+    # Convert to PIL Image directly from the pixmap samples
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    
+    # Free up memory
+    pix = None
+    
+    # Invert the image
+    img_inverted = ImageOps.invert(img)
+    
+    # Free up memory
+    img.close()
+    img = None
+    
+    # Encode inverted image in memory
+    buffer = io.BytesIO()
+    img_inverted.save(buffer, format="JPEG", optimize=True, quality=quality)
+    
+    # Free up memory
+    img_inverted.close()
+    img_inverted = None
+    
+    return buffer.getvalue()
+
+def _append_image_page(doc_out, width, height, image_data):
+    """Append a page with a black background and a full-page image to doc_out"""
+    new_page = doc_out.new_page(width=width, height=height)
+    shape = new_page.new_shape()
+    shape.draw_rect(new_page.rect)
+    shape.finish(fill=(0, 0, 0))
+    shape.commit()
+    
+    # Add inverted image to page, stretched over the page as rounding the render size may change its proportions
+    new_page.insert_image(new_page.rect, stream=image_data, keep_proportion=False)
+
+def _append_inverted_page(doc_out, page, display_list, scale, quality):
+    """Render a page from its display list, invert it and append it to doc_out on a black background"""
+    image_data = _render_inverted_image(display_list, scale, quality)
+    _append_image_page(doc_out, page.rect.width, page.rect.height, image_data)
+
+# How a page is converted, see classify_page
+PAGE_DARK = "dark"  # Already dark, copied unchanged
+PAGE_SCAN = "scan"  # Scanned, its image inverted at native resolution
+PAGE_RENDER = "render"  # Rendered and inverted
+
+def classify_page(page, display_list=None):
+    """
+    Decide how a page is converted to night mode
+    
+    Args:
+        page: The fitz.Page to classify
+        display_list: Optional display list of the page for the dark check
+    
+    Returns:
+        tuple: (kind, scan) with kind one of PAGE_DARK, PAGE_SCAN and
+        PAGE_RENDER, and scan the result of find_scanned_image for scans
+    """
+    if is_dark_page(page, display_list):
+        return PAGE_DARK, None
+    scan = find_scanned_image(page)
+    if scan is not None:
+        return PAGE_SCAN, scan
+    return PAGE_RENDER, None
+
+def append_night_mode_page(doc_out, doc_in, page_no, scale, quality, device=None, dpi=None,
+                           render=None, classification=None):
+    """
+    Convert one page to night mode and append it to doc_out
+    
+    Already-dark pages are copied unchanged and scans are inverted at native
+    resolution; every other page, and scans whose fast path fails, is
+    rendered. This is the per-page decision shared by all conversion paths.
+    
+    Args:
+        doc_out: The output fitz.Document
+        doc_in: The input fitz.Document
+        page_no: 0-based number of the page in doc_in
+        scale: Resolution scale factor, used when no device or dpi is given
+        quality: JPEG quality (1-100) for rendered pages and re-encoded scans
+        device: Target device preset name or viewport width in pixels
+        dpi: Target resolution in dots per inch
+        render: Optional callable render(page, display_list) replacing the
+            default render; display_list is None if none was built yet
+        classification: Result of classify_page if already known
+    
+    Returns:
+        str: How the page was converted, PAGE_DARK, PAGE_SCAN or PAGE_RENDER
+    """
+    page = doc_in[page_no]
+    display_list = None
+    if classification is None:
+        # Build the display list once and reuse it for the dark check and the render
+        display_list = page.get_displaylist()
+        classification = classify_page(page, display_list)
+    kind, scan = classification
+    
+    if kind == PAGE_DARK:
+        logger.info(f"Page {page_no+1} is already dark, copying unchanged")
+        doc_out.insert_pdf(doc_in, from_page=page_no, to_page=page_no)
+        return PAGE_DARK
+    
+    if kind == PAGE_SCAN and append_inverted_scan(doc_out, doc_in, page, quality, scan):
+        logger.info(f"Page {page_no+1} is a scan, inverted at native resolution")
+        return PAGE_SCAN
+    
+    if render is not None:
+        render(page, display_list)
+    else:
+        if display_list is None:
+            display_list = page.get_displaylist()
+        page_scale = resolve_page_scale(page.rect, scale, device, dpi)
+        _append_inverted_page(doc_out, page, display_list, page_scale, quality)
+    return PAGE_RENDER
+
+# JPEG quality of conversions that pick their scale from the document size
+SIZE_BASED_QUALITY = 70
+
+def size_based_scale(page_count, file_size):
+    """Pick a render scale from the document size, keeping the output small"""
+    if page_count > 5:
+        return 0.8  # Very low resolution for multi-page docs
+    if file_size > 1 * 1024 * 1024:  # 1MB
+        return 1.0  # Low resolution for large files
+    return 1.2  # Medium resolution for small files
+
+def _convert_document(doc_in, file_size, device=None):
+    """
+    Convert every page of an open document to night mode in memory
+    
+    Args:
+        doc_in: The open input fitz.Document
+        file_size: Size of the input PDF in bytes, used to pick the render scale
+        device: Optional target device (see resolve_page_scale) overriding the size-based scale
+    
+    Returns:
+        fitz.Document: The converted document, or None if no page could be processed
+    """
+    # Create output document
+    doc_out = fitz.open()
+    
+    # Adjust scale based on file size and page count to keep output small
+    scale = size_based_scale(len(doc_in), file_size)
+    logger.info(f"Using scale factor: {scale}")
+    
+    # Process each page with reduced memory usage and optimized for smaller file size
+    for page_no in range(len(doc_in)):
+        logger.info(f"Processing page {page_no+1}/{len(doc_in)}")
+        
+        try:
+            # Lower quality for smaller size in the serverless environment
+            append_night_mode_page(doc_out, doc_in, page_no, scale, SIZE_BASED_QUALITY, device)
+        
+        except Exception as page_error:
+            logger.error(f"Error processing page {page_no+1}: {str(page_error)}")
+            logger.error(traceback.format_exc())
+            # Continue with next page
+            continue
+    
+    # Check if we have any pages
+    if doc_out.page_count == 0:
+        logger.error("No pages were successfully processed")
+        doc_out.close()
+        return None
+    
+    return doc_out
+
+def convert_pdf_to_night_mode(input_path, output_path, device=None):
     try:
         # Check if input file exists
         if not os.path.exists(input_path):
@@ -26,83 +600,9 @@ def convert_pdf_to_night_mode(input_path, output_path):
         doc_in = fitz.open(input_path)
         logger.info(f"PDF opened. Pages: {len(doc_in)}")
         
-        # Create output document
-        doc_out = fitz.open()
-        
-        # Process each page with reduced memory usage and optimized for smaller file size
-        for page_no in range(len(doc_in)):
-            logger.info(f"Processing page {page_no+1}/{len(doc_in)}")
-            
-            try:
-                # Get the page
-                page = doc_in[page_no]
-                
-                # Adjust scale based on file size and page count to keep output small
-                if len(doc_in) > 5:
-                    scale = 0.8  # Very low resolution for multi-page docs
-                elif file_size > 1 * 1024 * 1024:  # 1MB
-                    scale = 1.0  # Low resolution for large files
-                else:
-                    scale = 1.2  # Medium resolution for small files
-                    
-                logger.info(f"Using scale factor: {scale}")
-                
-                # Render at a lower resolution to save memory and reduce output size
-                matrix = fitz.Matrix(scale, scale)
-                pix = page.get_pixmap(matrix=matrix, alpha=False)
-                
-                # Convert to PIL Image - use a direct path to avoid memory issues
-                img_path = f"{output_path}_temp_page_{page_no}.png"
-                pix.save(img_path)
-                logger.info(f"Saved temporary image: {img_path}")
-                
-                # Free up memory
-                pix = None
-                
-                # Open saved image
-                img = Image.open(img_path)
-                
-                # Invert the image
-                img_inverted = ImageOps.invert(img.convert("RGB"))
-                
-                # Free up memory
-                img.close()
-                img = None
-                
-                # Save inverted image with high compression for serverless environment
-                inverted_path = f"{output_path}_inverted_page_{page_no}.jpg"  # Use JPG for better compression
-                img_inverted.save(inverted_path, format="JPEG", optimize=True, quality=70)  # Lower quality for smaller size
-                
-                # Free up memory
-                img_inverted.close()
-                img_inverted = None
-                
-                # Create a new page with black background
-                new_page = doc_out.new_page(width=page.rect.width, height=page.rect.height)
-                shape = new_page.new_shape()
-                shape.draw_rect(new_page.rect)
-                shape.finish(fill=(0, 0, 0))
-                shape.commit()
-                
-                # Add inverted image to page
-                new_page.insert_image(new_page.rect, filename=inverted_path)
-                
-                # Clean up temporary files
-                try:
-                    os.remove(img_path)
-                    os.remove(inverted_path)
-                except Exception as e:
-                    logger.warning(f"Error removing temporary files: {e}")
-                
-            except Exception as page_error:
-                logger.error(f"Error processing page {page_no+1}: {str(page_error)}")
-                logger.error(traceback.format_exc())
-                # Continue with next page
-                continue
-        
-        # Check if we have any pages
-        if doc_out.page_count == 0:
-            logger.error("No pages were successfully processed")
+        doc_out = _convert_document(doc_in, file_size, device)
+        if doc_out is None:
+            doc_in.close()
             return False
         
         # Save with maximum compression options for serverless environment
@@ -128,7 +628,45 @@ def convert_pdf_to_night_mode(input_path, output_path):
         logger.error(traceback.format_exc())
         return False
 
-def process_pdf_in_chunks(input_path, output_path, start_page, end_page):
+def _convert_page_range(doc_in, start_page, end_page, device=None):
+    """
+    Convert a page range of an open document with the chunk settings
+    
+    Args:
+        doc_in: The open input fitz.Document
+        start_page: Starting page index (0-based)
+        end_page: Ending page index (exclusive)
+        device: Optional target device (see resolve_page_scale) replacing CHUNK_SCALE
+    
+    Returns:
+        fitz.Document: The converted pages, or None if no page could be processed
+    """
+    # Create output document
+    doc_out = fitz.open()
+    
+    # Process specified pages
+    for page_idx in range(start_page, end_page):
+        logger.info(f"Processing page {page_idx+1}")
+        
+        try:
+            # Scale and quality are fixed so output does not depend on how pages were grouped
+            append_night_mode_page(doc_out, doc_in, page_idx, CHUNK_SCALE, CHUNK_QUALITY, device)
+            
+        except Exception as page_error:
+            logger.error(f"Error processing page {page_idx+1}: {str(page_error)}")
+            logger.error(traceback.format_exc())
+            # Continue with next page
+            continue
+    
+    # Check if we have any pages
+    if doc_out.page_count == 0:
+        logger.error("No pages were successfully processed")
+        doc_out.close()
+        return None
+    
+    return doc_out
+
+def process_pdf_in_chunks(input_path, output_path, start_page, end_page, device=None):
     """
     Process a specific page range from a PDF and convert to night mode
     
@@ -137,6 +675,7 @@ def process_pdf_in_chunks(input_path, output_path, start_page, end_page):
         output_path: Path to save the output PDF file
         start_page: Starting page index (0-based)
         end_page: Ending page index (exclusive)
+        device: Optional target device (see resolve_page_scale)
     
     Returns:
         bool: True if successful, False otherwise
@@ -149,100 +688,18 @@ def process_pdf_in_chunks(input_path, output_path, start_page, end_page):
             logger.error(f"Error: Input file '{input_path}' not found.")
             return False
             
-        # Open input document
-        doc_in = fitz.open(input_path)
-        total_pages = len(doc_in)
-        
-        # Validate page range
-        if start_page < 0 or end_page > total_pages or start_page >= end_page:
-            logger.error(f"Invalid page range: {start_page}-{end_page}, document has {total_pages} pages")
-            return False
-        
-        # Create output document
-        doc_out = fitz.open()
-        
-        # Get file size
-        file_size = os.path.getsize(input_path)
-        
-        # Process specified pages
-        for page_idx in range(start_page, end_page):
-            logger.info(f"Processing page {page_idx+1}")
+        # Get the input document from the cache, opening it on first use
+        with checkout_document(input_path) as doc_in:
+            total_pages = len(doc_in)
             
-            try:
-                # Get the page
-                page = doc_in[page_idx]
-                
-                # Use better resolution for chunks since we're processing fewer pages at once
-                chunk_size = end_page - start_page
-                if chunk_size <= 5:
-                    scale = 1.5  # Higher quality for small chunks
-                elif chunk_size <= 10:
-                    scale = 1.2  # Medium quality for medium chunks
-                else:
-                    scale = 0.8  # Lower quality for large chunks
-                
-                logger.info(f"Using chunk scale factor: {scale}")
-                
-                # Render page to image
-                matrix = fitz.Matrix(scale, scale)
-                pix = page.get_pixmap(matrix=matrix, alpha=False)
-                
-                # Save to temporary file to avoid memory issues
-                temp_img_path = f"{output_path}_temp_{page_idx}.jpg"
-                pix.save(temp_img_path, "jpeg", quality=80)
-                
-                # Free memory
-                pix = None
-                
-                # Open with PIL
-                img = Image.open(temp_img_path)
-                
-                # Invert colors
-                img_inverted = ImageOps.invert(img.convert("RGB"))
-                
-                # Free memory
-                img.close()
-                img = None
-                
-                # Set quality based on chunk size
-                quality = 75  # Default
-                if chunk_size <= 5:
-                    quality = 85  # Better quality for small chunks
-                
-                # Save inverted image
-                inverted_path = f"{output_path}_inverted_{page_idx}.jpg"
-                img_inverted.save(inverted_path, format="JPEG", optimize=True, quality=quality)
-                
-                # Free memory
-                img_inverted.close()
-                img_inverted = None
-                
-                # Create a new page with black background
-                new_page = doc_out.new_page(width=page.rect.width, height=page.rect.height)
-                shape = new_page.new_shape()
-                shape.draw_rect(new_page.rect)
-                shape.finish(fill=(0, 0, 0))
-                shape.commit()
-                
-                # Add inverted image to page
-                new_page.insert_image(new_page.rect, filename=inverted_path)
-                
-                # Clean up temporary files
-                try:
-                    os.remove(temp_img_path)
-                    os.remove(inverted_path)
-                except Exception as e:
-                    logger.warning(f"Error removing temporary files: {e}")
-                
-            except Exception as page_error:
-                logger.error(f"Error processing page {page_idx+1}: {str(page_error)}")
-                logger.error(traceback.format_exc())
-                # Continue with next page
-                continue
+            # Validate page range
+            if start_page < 0 or end_page > total_pages or start_page >= end_page:
+                logger.error(f"Invalid page range: {start_page}-{end_page}, document has {total_pages} pages")
+                return False
+            
+            doc_out = _convert_page_range(doc_in, start_page, end_page, device)
         
-        # Check if we have any pages
-        if doc_out.page_count == 0:
-            logger.error("No pages were successfully processed")
+        if doc_out is None:
             return False
         
         # Save the chunk
@@ -252,7 +709,6 @@ def process_pdf_in_chunks(input_path, output_path, start_page, end_page):
                      deflate=True,
                      clean=True)
         doc_out.close()
-        doc_in.close()
         
         # Verify the output
         if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
@@ -267,11 +723,349 @@ def process_pdf_in_chunks(input_path, output_path, start_page, end_page):
         logger.error(traceback.format_exc())
         return False
 
+def process_chunk_bytes(pdf_data):
+    """
+    Convert every page of an in-memory chunk PDF with the chunk settings
+    
+    Args:
+        pdf_data: The chunk PDF as bytes
+    
+    Returns:
+        bytes: The converted chunk, or None if the conversion failed
+    """
+    try:
+        doc_in = fitz.open(stream=pdf_data, filetype="pdf")
+        logger.info(f"Processing in-memory chunk with {len(doc_in)} pages")
+        
+        doc_out = _convert_page_range(doc_in, 0, len(doc_in))
+        if doc_out is None:
+            doc_in.close()
+            return None
+        
+        output_data = doc_out.tobytes(garbage=4, deflate=True, clean=True)
+        doc_out.close()
+        doc_in.close()
+        return output_data
+        
+    except Exception as e:
+        logger.error(f"Error processing chunk: {e}")
+        logger.error(traceback.format_exc())
+        return None
+
+def combine_pdf_chunks(chunk_paths, output_path):
+    """
+    Merge converted chunk files into a single PDF
+    
+    Args:
+        chunk_paths: Paths of the chunk PDFs in page order
+        output_path: Path to save the combined PDF
+    
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        doc_out = fitz.open()
+        for chunk_path in chunk_paths:
+            logger.info(f"Adding chunk {chunk_path}")
+            doc_chunk = fitz.open(chunk_path)
+            doc_out.insert_pdf(doc_chunk)
+            doc_chunk.close()
+        
+        if doc_out.page_count == 0:
+            logger.error("No pages to combine")
+            return False
+        
+        logger.info(f"Saving combined PDF to {output_path}")
+        doc_out.save(output_path, garbage=4, deflate=True, clean=True)
+        doc_out.close()
+        return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+        
+    except Exception as e:
+        logger.error(f"Error combining chunks: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+# Render scale and JPEG quality of the quick first pass of progressive conversion
+PREVIEW_SCALE = 0.5
+PREVIEW_QUALITY = 40
+# Display lists kept between the two passes, bounding the memory progressive conversion holds
+PROGRESSIVE_MAX_DISPLAY_LISTS = 64
+
+def _save_atomic(doc_out, output_path):
+    """Save a document so readers never see a partially written file"""
+    temp_path = f"{output_path}.tmp"
+    doc_out.save(temp_path, garbage=4, deflate=True, clean=True)
+    os.replace(temp_path, output_path)
+
+def convert_pdf_progressive(input_path, preview_path, output_path, on_preview=None, device=None):
+    """
+    Convert a PDF in two passes: a quick low-resolution preview, then full quality
+    
+    The first pass classifies every page and writes a complete preview PDF at
+    PREVIEW_SCALE. Already-dark and scanned pages are final after the first
+    pass and are copied from the preview, so the second pass only re-renders
+    the remaining pages, reusing their display lists where they were kept.
+    A page that fails in the second pass keeps its preview; if a page cannot
+    even be previewed, the conversion fails and nothing is written.
+    Both files are written atomically, so the preview can be served while
+    the second pass runs.
+    
+    Args:
+        input_path: Path to the input PDF file
+        preview_path: Path to save the low-resolution preview PDF
+        output_path: Path to save the full-quality PDF
+        on_preview: Optional callable invoked once the preview has been saved
+        device: Optional target device (see resolve_page_scale) for the full pass
+    
+    Returns:
+        bool: True if the full-quality PDF was written, False otherwise
+    """
+    try:
+        if not os.path.exists(input_path):
+            logger.error(f"Error: Input file '{input_path}' not found.")
+            return False
+        
+        doc_in = fitz.open(input_path)
+        logger.info(f"Progressive conversion of {input_path}, {len(doc_in)} pages")
+        
+        # First pass: pages that need rendering get a quick low-resolution render
+        doc_preview = fitz.open()
+        preview_index = {}  # Input page number -> page number in the preview
+        final_pages = set()  # Pages whose preview is already full quality
+        display_lists = {}
+        
+        def render_preview(page, display_list):
+            scale = resolve_page_scale(page.rect, CHUNK_SCALE, device)
+            _append_inverted_page(doc_preview, page, display_list,
+                                  min(PREVIEW_SCALE, scale), PREVIEW_QUALITY)
+            if len(display_lists) < PROGRESSIVE_MAX_DISPLAY_LISTS:
+                display_lists[page.number] = display_list
+        
+        for page_no in range(len(doc_in)):
+            try:
+                kind = append_night_mode_page(doc_preview, doc_in, page_no, CHUNK_SCALE, CHUNK_QUALITY,
+                                              device, render=render_preview)
+                if kind != PAGE_RENDER:
+                    final_pages.add(page_no)
+                preview_index[page_no] = doc_preview.page_count - 1
+                
+            except Exception as page_error:
+                logger.error(f"Error previewing page {page_no+1}: {str(page_error)}")
+                logger.error(traceback.format_exc())
+                continue
+        
+        # A document with pages missing must not pass as a conversion
+        if doc_preview.page_count != len(doc_in):
+            logger.error(f"Only {doc_preview.page_count} of {len(doc_in)} pages could be previewed")
+            doc_preview.close()
+            doc_in.close()
+            return False
+        
+        _save_atomic(doc_preview, preview_path)
+        logger.info(f"Preview saved: {preview_path}")
+        if on_preview is not None:
+            on_preview()
+        
+        # Second pass: re-render only what the preview rendered at low resolution
+        doc_out = fitz.open()
+        for page_no in range(len(doc_in)):
+            index = preview_index[page_no]
+            if page_no not in final_pages:
+                try:
+                    page = doc_in[page_no]
+                    display_list = display_lists.pop(page_no, None) or page.get_displaylist()
+                    scale = resolve_page_scale(page.rect, CHUNK_SCALE, device)
+                    _append_inverted_page(doc_out, page, display_list, scale, CHUNK_QUALITY)
+                    display_list = None
+                    continue
+                    
+                except Exception as page_error:
+                    # Keep the preview of the page rather than leaving it out
+                    logger.error(f"Error processing page {page_no+1}, keeping its preview: {str(page_error)}")
+                    logger.error(traceback.format_exc())
+                    if doc_out.page_count > page_no:
+                        doc_out.delete_page(-1)
+            
+            doc_out.insert_pdf(doc_preview, from_page=index, to_page=index)
+        
+        doc_preview.close()
+        
+        _save_atomic(doc_out, output_path)
+        doc_out.close()
+        doc_in.close()
+        logger.info(f"Full-quality PDF saved: {output_path}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error in progressive conversion: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+# A converted page: 0-based page number, page size in points and either the
+# inverted page as JPEG bytes (image_data) or, for pages that are not rendered
+# (already dark, or scans inverted at native resolution), a single-page night
+# mode PDF (pdf_data). Exactly one of image_data and pdf_data is set.
+ConvertedPage = namedtuple("ConvertedPage", ["page_no", "width", "height", "image_data", "pdf_data"])
+
+def extract_page(doc, page_no):
+    """Copy one page of a document into a standalone single-page PDF"""
+    doc_page = fitz.open()
+    doc_page.insert_pdf(doc, from_page=page_no, to_page=page_no)
+    data = doc_page.tobytes(garbage=4, deflate=True)
+    doc_page.close()
+    return data
+
+def append_converted_page(doc_out, converted):
+    """Append a ConvertedPage to an output document"""
+    if converted.pdf_data is None:
+        _append_image_page(doc_out, converted.width, converted.height, converted.image_data)
+        return
+    
+    doc_page = fitz.open(stream=converted.pdf_data, filetype="pdf")
+    doc_out.insert_pdf(doc_page)
+    doc_page.close()
+
+def _open_document(source):
+    """Open a fitz.Document from a path, bytes or a binary file-like object"""
+    if isinstance(source, fitz.Document):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=bytes(source), filetype="pdf")
+    if hasattr(source, "read"):
+        return fitz.open(stream=source.read(), filetype="pdf")
+    return fitz.open(source)
+
+def iter_converted_pages(source, scale=CHUNK_SCALE, quality=CHUNK_QUALITY, device=None, dpi=None):
+    """
+    Convert a PDF page by page, yielding each page as soon as it is ready
+    
+    Only one page is held in memory at a time, so callers can stream pages to
+    their own sink with constant memory. Every page is self-contained and does
+    not need the input document, see ConvertedPage. Pages that fail to
+    convert are logged and skipped, as in the other conversion functions.
+    
+    Args:
+        source: Path, bytes, binary file-like object or open fitz.Document
+        scale: Resolution scale factor, used when no device or dpi is given
+        quality: JPEG quality (1-100)
+        device: Target device preset name or viewport width in pixels
+        dpi: Target resolution in dots per inch
+    
+    Yields:
+        ConvertedPage: The converted page and its geometry
+    """
+    rendered = []  # Image of the page being converted, if it needed rendering
+    
+    def render_image(page, display_list):
+        page_scale = resolve_page_scale(page.rect, scale, device, dpi)
+        rendered.append(_render_inverted_image(display_list, page_scale, quality))
+    
+    doc_in = _open_document(source)
+    try:
+        for page_no in range(len(doc_in)):
+            try:
+                page = doc_in[page_no]
+                image_data = None
+                pdf_data = None
+                
+                # Pages that are not rendered are kept as a single-page PDF
+                doc_page = fitz.open()
+                try:
+                    kind = append_night_mode_page(doc_page, doc_in, page_no, scale, quality,
+                                                  device, dpi, render=render_image)
+                    if kind == PAGE_RENDER:
+                        image_data = rendered.pop()
+                    else:
+                        pdf_data = doc_page.tobytes(garbage=4, deflate=True)
+                finally:
+                    doc_page.close()
+                
+            except Exception as page_error:
+                logger.error(f"Error processing page {page_no+1}: {str(page_error)}")
+                logger.error(traceback.format_exc())
+                continue
+            
+            yield ConvertedPage(page_no, page.rect.width, page.rect.height, image_data, pdf_data)
+    finally:
+        # Only close documents opened here
+        if doc_in is not source:
+            doc_in.close()
+
+def convert_bytes(pdf_data, scale=CHUNK_SCALE, quality=CHUNK_QUALITY, device=None, dpi=None):
+    """
+    Convert a PDF held in memory to night mode
+    
+    Args:
+        pdf_data: The input PDF as bytes
+        scale: Resolution scale factor, used when no device or dpi is given;
+            None picks it from the document size (see size_based_scale)
+        quality: JPEG quality (1-100)
+        device: Target device preset name or viewport width in pixels
+        dpi: Target resolution in dots per inch
+    
+    Returns:
+        bytes: The converted PDF, or None if the conversion failed
+    """
+    try:
+        logger.info(f"Opening input PDF from memory, size: {len(pdf_data)} bytes")
+        doc_in = _open_document(pdf_data)
+        doc_out = fitz.open()
+        try:
+            if scale is None:
+                scale = size_based_scale(len(doc_in), len(pdf_data))
+            
+            for converted in iter_converted_pages(doc_in, scale, quality, device, dpi):
+                append_converted_page(doc_out, converted)
+            
+            if doc_out.page_count == 0:
+                logger.error("No pages were successfully processed")
+                return None
+            
+            output_data = doc_out.tobytes(garbage=4, deflate=True, clean=True)
+            logger.info(f"PDF conversion complete. Output size: {len(output_data)} bytes")
+            return output_data
+        finally:
+            doc_out.close()
+            doc_in.close()
+        
+    except Exception as e:
+        logger.error(f"Error converting PDF: {e}")
+        logger.error(traceback.format_exc())
+        return None
+
+def convert_stream(input_stream, output_stream, scale=CHUNK_SCALE, quality=CHUNK_QUALITY, device=None, dpi=None):
+    """
+    Convert a PDF read from a binary file-like object and write the result to another
+    
+    The input is read completely because PDF parsing needs random access, and
+    the output is written in one piece once the document is complete.
+    
+    Args:
+        input_stream: Readable binary file-like object with the input PDF
+        output_stream: Writable binary file-like object for the night mode PDF
+        scale: Resolution scale factor, used when no device or dpi is given
+        quality: JPEG quality (1-100)
+        device: Target device preset name or viewport width in pixels
+        dpi: Target resolution in dots per inch
+    
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    output_data = convert_bytes(input_stream.read(), scale, quality, device, dpi)
+    if output_data is None:
+        return False
+    
+    output_stream.write(output_data)
+    output_stream.flush()
+    return True
+
 def main():
     # Create command line argument parser
     parser = argparse.ArgumentParser(description='Convert a PDF to night mode (inverted colors).')
     parser.add_argument('input_pdf', help='Path to the input PDF file')
     parser.add_argument('-o', '--output', help='Path to save the night mode PDF (default: adds _night_mode suffix)')
+    parser.add_argument('-d', '--device', type=parse_device,
+                        help=f"Target reading device ({', '.join(DEVICE_PRESETS)}) or viewport width in pixels")
     
     args = parser.parse_args()
     
@@ -281,7 +1075,7 @@ def main():
         args.output = f"{input_base}_night_mode.pdf"
     
     print(f"Converting {args.input_pdf} to night mode...")
-    convert_pdf_to_night_mode(args.input_pdf, args.output)
+    convert_pdf_to_night_mode(args.input_pdf, args.output, device=args.device)
 
 if __name__ == "__main__":
     main()